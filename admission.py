@@ -0,0 +1,164 @@
+# Admission control for the routes that wait on bcrypt, SMTP or the ESP32.
+#
+# Each limited route may only have `limit` requests in flight per process, and all of
+# them together may use `capacity - reserved` slots: the reserved slots are only for
+# priority routes (verifyOtp), so a user holding an OTP can still finish logging in
+# while the expensive routes are saturated. Routes without a limit are not counted.
+#
+# A request that finds no free slot waits in a queue, CoDel style: normally for up to
+# `interval`, but once the queue has not been empty for a whole interval only for
+# `target`, so a standing queue sheds quickly instead of holding every worker thread.
+# A route can also name a downstream delay (the age of the oldest message in the mail
+# queue, of the oldest undelivered PIN); when it stays above its target for
+# downstream_interval, the route answers 503 at once rather than adding to the backlog.
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify
+
+import metrics
+
+
+class _Lane:
+    def __init__(self, name, limit, priority, downstream):
+        self.name = name
+        self.limit = limit
+        self.priority = priority
+        self.downstream = downstream  # (probe returning seconds, target seconds) or None
+        self.in_flight = 0
+        self.above_since = None  # When the downstream delay last went above its target
+        self.admitted = 0
+        self.queued = 0
+        self.shed = {'queue': 0, 'downstream': 0}
+
+
+class AdmissionController:
+    def __init__(self, capacity=16, reserved=2, target=0.005, interval=0.1,
+                 downstream_interval=1.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity)
+        self.target = target
+        self.interval = interval
+        self.downstream_interval = downstream_interval
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._lanes = {}
+        self._in_flight = 0
+        self._waiting = 0
+        self._nonempty_since = None  # When the queue last went from empty to non-empty
+
+    def _lane(self, name, limit, priority, downstream):
+        with self._cond:
+            lane = self._lanes.get(name)
+            if lane is None:
+                lane = self._lanes[name] = _Lane(name, limit or self.capacity, priority, downstream)
+            return lane
+
+    def _fits(self, lane):
+        shared = self.capacity if lane.priority else self.capacity - self.reserved
+        return lane.in_flight < lane.limit and self._in_flight < shared
+
+    def _downstream_delay(self, lane, now):
+        # Returns the downstream delay once it has stayed above target for an interval, else None
+        if lane.downstream is None:
+            return None
+        probe, target = lane.downstream
+        delay = probe()
+        with self._cond:
+            if delay < target:
+                lane.above_since = None
+                return None
+            if lane.above_since is None:
+                lane.above_since = now
+            return delay if now - lane.above_since >= self.downstream_interval else None
+
+    def acquire(self, lane):
+        # Returns None once admitted (call release() afterwards), or (reason, retry_after) when shed
+        now = self._clock()
+        delay = self._downstream_delay(lane, now)
+        if delay is not None:
+            with self._cond:
+                lane.shed['downstream'] += 1
+            return 'downstream', delay
+        with self._cond:
+            if self._fits(lane):
+                self._admit(lane)
+                return None
+            # A queue that has not drained for a whole interval is standing: only wait `target`
+            standing = self._waiting > 0 and now - self._nonempty_since >= self.interval
+            deadline = now + (self.target if standing else self.interval)
+            if self._waiting == 0:
+                self._nonempty_since = now
+            self._waiting += 1
+            lane.queued += 1
+            try:
+                while not self._fits(lane):
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        lane.shed['queue'] += 1
+                        return 'queue', self.interval
+                    self._cond.wait(remaining)
+                self._admit(lane)
+            finally:
+                self._waiting -= 1
+                if self._waiting == 0:
+                    self._nonempty_since = None
+        metrics.observe('admission_queue_seconds', self._clock() - now, route=lane.name)
+        return None
+
+    def _admit(self, lane):
+        lane.in_flight += 1
+        lane.admitted += 1
+        self._in_flight += 1
+
+    def release(self, lane):
+        with self._cond:
+            lane.in_flight -= 1
+            self._in_flight -= 1
+            self._cond.notify_all()  # Waiters of different lanes wait for different slots
+
+    def limit(self, route, limit=None, priority=False, downstream=None):
+        # Decorator answering 503 with Retry-After when the route is shed.
+        # downstream: (callable returning the current delay in seconds, target seconds)
+        lane = self._lane(route, limit, priority, downstream)
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                shed = self.acquire(lane)
+                if shed is not None:
+                    reason, wait = shed
+                    metrics.inc('admission_shed_total', route=route, reason=reason)
+                    response = jsonify(success=False, message='Server is busy, try again later')
+                    response.status_code = 503
+                    response.headers['Retry-After'] = str(max(1, min(math.ceil(wait), 60)))
+                    return response
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release(lane)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._cond:
+            return {
+                'capacity': self.capacity,
+                'reserved': self.reserved,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'routes': {
+                    name: {
+                        'limit': lane.limit,
+                        'priority': lane.priority,
+                        'in_flight': lane.in_flight,
+                        'admitted': lane.admitted,
+                        'queued': lane.queued,
+                        'shed': dict(lane.shed),
+                        'downstream_above_target': lane.above_since is not None,
+                    }
+                    for name, lane in self._lanes.items()
+                },
+            }
@@ -124,141 +124,734 @@
 #     app.run(debug=True)
 
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_mail import Mail, Message
 from flask_cors import CORS
 import random
-import sqlite3
+import json
 import logging
+import math
 import os
 import threading
-import requests  # Import requests to send HTTP requests
-
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+import time
+import db
+import database
+from mailer import MailDispatcher
+from pin_dispatch import PinDispatcher, DELIVERED, ACCEPTED, QUEUED
+from devices import DeviceRegistry
+from outbox import PinOutbox
+from pin_pull import PinMailbox, TooManyWaiters
+from sessions import SessionTokens, bearer_token
+from fingerprints import FingerprintStore, TemplateError, parse_template
+from audit import AuditLog
+import state
+import passwords
+from otp import TotpGenerator
+import metrics
+import logging_setup
+from ratelimit import RateLimiter
+from admission import AdmissionController
+from profiler import RequestProfiler
+import schemas
+from schemas import Schema
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Set up logging, records are written by a background thread as JSON with secrets redacted
+logging_setup.configure_logging(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    fmt=os.environ.get('LOG_FORMAT', 'json'),
+    sampling=logging_setup.parse_sampling(os.environ.get('LOG_SAMPLING')),  # e.g. 'pin_dispatch=0.1,mailer=0.5'
+)
+logger = logging.getLogger(__name__)
 
 # Initialize the Flask application
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Number of reverse proxies in front of the app (e.g. 1 on Heroku), so rate limits see the real client IP
+app.config['PROXY_COUNT'] = int(os.environ.get('PROXY_COUNT', 0))
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'])
+
 # Configure Flask-Mail using environment variables
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')  # Use environment variable
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')  # Use environment variable
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_USERNAME')  # Use environment variable
 
-mail = Mail(app)
+# Background mail dispatch
+app.config['MAIL_DISPATCH_WORKERS'] = int(os.environ.get('MAIL_DISPATCH_WORKERS', 2))
+app.config['MAIL_DISPATCH_BATCH_SIZE'] = int(os.environ.get('MAIL_DISPATCH_BATCH_SIZE', 20))
+app.config['MAIL_DISPATCH_MAX_RETRIES'] = int(os.environ.get('MAIL_DISPATCH_MAX_RETRIES', 3))
+app.config['MAIL_DISPATCH_BACKOFF'] = float(os.environ.get('MAIL_DISPATCH_BACKOFF', 0.5))  # Seconds, doubled per retry
+app.config['MAIL_DISPATCH_IDLE_TIMEOUT'] = float(os.environ.get('MAIL_DISPATCH_IDLE_TIMEOUT', 30))
 
-# In-memory storage for OTP and PIN
-otp_storage = {}
-pin_storage = {}
-
-def create_connection():
-    conn = sqlite3.connect('users.db')
-    return conn
+mail = Mail(app)
+mail_dispatcher = MailDispatcher(
+    app, mail,
+    workers=app.config['MAIL_DISPATCH_WORKERS'],
+    batch_size=app.config['MAIL_DISPATCH_BATCH_SIZE'],
+    max_retries=app.config['MAIL_DISPATCH_MAX_RETRIES'],
+    backoff=app.config['MAIL_DISPATCH_BACKOFF'],
+    idle_timeout=app.config['MAIL_DISPATCH_IDLE_TIMEOUT'],
+)
+
+# ESP32 PIN delivery
+app.config['ESP32_URL'] = os.environ.get('ESP32_URL', "http://<192.168.1.100>/receivePin")  # Default device, for users without one in the registry
+app.config['ESP32_WORKERS'] = int(os.environ.get('ESP32_WORKERS', 8))  # Concurrent deliveries across all devices
+app.config['DEVICE_CACHE_TTL'] = float(os.environ.get('DEVICE_CACHE_TTL', 30))  # Seconds between reloads of the device registry
+app.config['ESP32_CONNECT_TIMEOUT'] = float(os.environ.get('ESP32_CONNECT_TIMEOUT', 2))
+app.config['ESP32_READ_TIMEOUT'] = float(os.environ.get('ESP32_READ_TIMEOUT', 5))
+app.config['ESP32_MAX_RETRIES'] = int(os.environ.get('ESP32_MAX_RETRIES', 3))
+app.config['ESP32_BREAKER_THRESHOLD'] = int(os.environ.get('ESP32_BREAKER_THRESHOLD', 5))  # Consecutive failures before the circuit opens
+app.config['ESP32_BREAKER_RESET'] = float(os.environ.get('ESP32_BREAKER_RESET', 30))  # Seconds before trying a dead device again
+app.config['ESP32_DELIVERY_WAIT'] = float(os.environ.get('ESP32_DELIVERY_WAIT', 0))  # Seconds /api/sendPin waits for a delivery ack
+
+device_registry = DeviceRegistry(app.config['ESP32_URL'], cache_ttl=app.config['DEVICE_CACHE_TTL'])
+pin_dispatcher = PinDispatcher(
+    device_registry,
+    workers=app.config['ESP32_WORKERS'],
+    connect_timeout=app.config['ESP32_CONNECT_TIMEOUT'],
+    read_timeout=app.config['ESP32_READ_TIMEOUT'],
+    max_retries=app.config['ESP32_MAX_RETRIES'],
+    failure_threshold=app.config['ESP32_BREAKER_THRESHOLD'],
+    reset_timeout=app.config['ESP32_BREAKER_RESET'],
+)
+
+# OTP and PIN lifetimes
+app.config['OTP_TTL'] = float(os.environ.get('OTP_TTL', 300))  # Seconds
+app.config['PIN_TTL'] = float(os.environ.get('PIN_TTL', 120))  # Seconds
+app.config['STATE_STORE_MAX_SIZE'] = int(os.environ.get('STATE_STORE_MAX_SIZE', 100000))  # Per namespace, memory backend only
+
+# Durable outbox for PINs the device did not take on the first attempt
+app.config['PIN_OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('PIN_OUTBOX_MAX_ATTEMPTS', 10))
+app.config['PIN_OUTBOX_BACKOFF'] = float(os.environ.get('PIN_OUTBOX_BACKOFF', 1))  # Seconds, doubled per attempt
+app.config['PIN_OUTBOX_MAX_BACKOFF'] = float(os.environ.get('PIN_OUTBOX_MAX_BACKOFF', 30))
+app.config['PIN_OUTBOX_BATCH_SIZE'] = int(os.environ.get('PIN_OUTBOX_BATCH_SIZE', 50))
+app.config['PIN_OUTBOX_RETENTION'] = float(os.environ.get('PIN_OUTBOX_RETENTION', 86400))  # Seconds finished deliveries stay listed
+# Clients allowed to see door controllers and their deliveries (/api/deviceStats,
+# /api/pinStats, /api/pinOutbox) and to retry deliveries; nobody when unset
+app.config['DEVICE_ADMIN_TRUSTED_IPS'] = frozenset(ip for ip in os.environ.get('DEVICE_ADMIN_TRUSTED_IPS', '').split(',') if ip)
+
+# Pull devices (registered with address 'pull') hold a long-poll or SSE request open instead
+# Open pull requests per worker. Each holds a request thread (or greenlet) for its whole
+# wait, so by default they may take at most half of ADMISSION_CAPACITY
+app.config['PIN_PULL_MAX_WAITERS'] = int(os.environ.get('PIN_PULL_MAX_WAITERS', max(1, int(os.environ.get('ADMISSION_CAPACITY', 16)) // 2)))
+app.config['PIN_PULL_MAX_WAIT'] = float(os.environ.get('PIN_PULL_MAX_WAIT', 30))  # Longest long-poll, seconds
+app.config['PIN_PULL_RECHECK'] = float(os.environ.get('PIN_PULL_RECHECK', 2))  # Seconds before a PIN sent via another worker is seen
+app.config['PIN_PULL_HEARTBEAT'] = float(os.environ.get('PIN_PULL_HEARTBEAT', 15))  # Seconds between SSE keep-alive comments
+app.config['PIN_PULL_STREAM_MAX'] = float(os.environ.get('PIN_PULL_STREAM_MAX', 300))  # SSE streams end after this, devices reconnect
+
+pin_mailbox = PinMailbox(max_waiters=app.config['PIN_PULL_MAX_WAITERS'])
+
+pin_outbox = PinOutbox(
+    pin_dispatcher, device_registry, mailbox=pin_mailbox,
+    pin_ttl=app.config['PIN_TTL'],
+    max_attempts=app.config['PIN_OUTBOX_MAX_ATTEMPTS'],
+    backoff=app.config['PIN_OUTBOX_BACKOFF'],
+    max_backoff=app.config['PIN_OUTBOX_MAX_BACKOFF'],
+    batch_size=app.config['PIN_OUTBOX_BATCH_SIZE'],
+    lease=sum(app.config[k] for k in ('ESP32_CONNECT_TIMEOUT', 'ESP32_READ_TIMEOUT')) * (app.config['ESP32_MAX_RETRIES'] + 1),
+    retention=app.config['PIN_OUTBOX_RETENTION'],
+)
+
+# OTP mode: 'random' stores each code, 'totp' derives codes from OTP_SECRET and only
+# remembers which codes were already used
+app.config['OTP_MODE'] = os.environ.get('OTP_MODE', 'random')
+app.config['OTP_SECRET'] = os.environ.get('OTP_SECRET')  # Must be the same on every worker
+app.config['OTP_STEP'] = int(os.environ.get('OTP_STEP', 300))  # Seconds per TOTP step
+app.config['OTP_WINDOW'] = int(os.environ.get('OTP_WINDOW', 1))  # Past steps still accepted
+
+# Coalescing of repeated OTP requests for the same email
+app.config['OTP_RESEND_COOLDOWN'] = float(os.environ.get('OTP_RESEND_COOLDOWN', 30))  # Seconds, 0 disables
+app.config['OTP_REUSE_WINDOW'] = float(os.environ.get('OTP_REUSE_WINDOW', 120))  # Seconds a pending OTP is re-sent instead of replaced
+
+# Fingerprint templates, one float32 row per enrolled user in a memory-mapped file
+app.config['FINGERPRINT_STORE'] = os.environ.get('FINGERPRINT_STORE', 'fingerprints.npy')
+app.config['FINGERPRINT_THRESHOLD'] = float(os.environ.get('FINGERPRINT_THRESHOLD', 0.92))  # Cosine similarity needed for a match
+app.config['FINGERPRINT_BATCH_SIZE'] = int(os.environ.get('FINGERPRINT_BATCH_SIZE', 16384))  # Templates scored per block in 1:N
+
+fingerprint_store = FingerprintStore(app.config['FINGERPRINT_STORE'], batch_size=app.config['FINGERPRINT_BATCH_SIZE'])
+
+# Audit log of logins, OTP checks and PIN deliveries, written behind the request in batches
+app.config['AUDIT_BUFFER_SIZE'] = int(os.environ.get('AUDIT_BUFFER_SIZE', 10000))  # Events held before the oldest are dropped
+app.config['AUDIT_BATCH_SIZE'] = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+app.config['AUDIT_FLUSH_INTERVAL'] = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1))  # Seconds, the most a crash can lose
+app.config['AUDIT_RETENTION_DAYS'] = int(os.environ.get('AUDIT_RETENTION_DAYS', 90))
+
+audit_log = AuditLog(
+    max_buffer=app.config['AUDIT_BUFFER_SIZE'],
+    batch_size=app.config['AUDIT_BATCH_SIZE'],
+    flush_interval=app.config['AUDIT_FLUSH_INTERVAL'],
+    retention_days=app.config['AUDIT_RETENTION_DAYS'],
+)
+
+# Session tokens issued by /api/verifyOtp. SESSION_SECRET_KEYS is a comma separated list,
+# oldest first: the last key signs, all of them verify. Required, and the same on every
+# worker: a per-process random key would reject tokens served by another worker.
+app.config['SESSION_TTL'] = float(os.environ.get('SESSION_TTL', 600))  # Seconds
+app.config['SESSION_SECRET_KEYS'] = [k for k in os.environ.get('SESSION_SECRET_KEYS', '').split(',') if k]
+app.config['SESSION_REVOCATION_REFRESH'] = float(os.environ.get('SESSION_REVOCATION_REFRESH', 5))  # Seconds a logout takes to reach other workers
+
+totp = None
+if app.config['OTP_MODE'] == 'totp':
+    totp = TotpGenerator(app.config['OTP_SECRET'], step=app.config['OTP_STEP'], window=app.config['OTP_WINDOW'])
+
+# Storage for OTP and PIN, entries expire on their own.
+# 'memory' is per process; use 'sqlite' when running more than one gunicorn worker.
+app.config['STATE_BACKEND'] = os.environ.get('STATE_BACKEND', 'memory')
+state_backend = state.create_backend(
+    app.config['STATE_BACKEND'],
+    {
+        state.OTP: app.config['OTP_TTL'],
+        state.OTP_USED: totp.replay_ttl() if totp else app.config['OTP_TTL'],
+        state.OTP_ISSUED: min(app.config['OTP_REUSE_WINDOW'], app.config['OTP_TTL']),
+        state.OTP_COOLDOWN: app.config['OTP_RESEND_COOLDOWN'],
+        state.PIN: app.config['PIN_TTL'],
+        state.SESSION_REVOKED: app.config['SESSION_TTL'],
+    },
+    max_size=app.config['STATE_STORE_MAX_SIZE'],
+)
+
+sessions = SessionTokens(
+    app.config['SESSION_SECRET_KEYS'],
+    ttl=app.config['SESSION_TTL'],
+    backend=state_backend,
+    refresh_interval=app.config['SESSION_REVOCATION_REFRESH'],
+)
+
+# Metrics
+metrics.describe('http_requests_total', 'counter', 'Requests by route, method and status')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Request latency by route')
+metrics.describe('db_query_duration_seconds', 'histogram', 'SQLite query latency')
+metrics.describe('password_check_duration_seconds', 'histogram', 'bcrypt check latency including pool wait')
+metrics.describe('otp_issue_duration_seconds', 'histogram', 'OTP generation and storage latency')
+metrics.describe('otp_verifications_total', 'counter', 'OTP verification attempts by result')
+metrics.describe('mail_send_duration_seconds', 'histogram', 'SMTP send latency per message')
+metrics.describe('mail_queue_wait_seconds', 'histogram', 'Time a message waited in the mail queue')
+metrics.describe('esp32_request_duration_seconds', 'histogram', 'Latency of each POST to the ESP32')
+metrics.describe('esp32_delivery_duration_seconds', 'histogram', 'PIN delivery latency including retries')
+metrics.describe('errors_total', 'counter', 'Errors by stage')
+metrics.describe('fingerprint_match_duration_seconds', 'histogram', 'Template matching latency by mode (1:1 verify, 1:N identify)')
+metrics.describe('fingerprint_verifications_total', 'counter', 'Fingerprint checks by result')
+metrics.describe('user_cache_requests_total', 'counter', 'User lookups by cache result (hit, negative_hit, miss)')
+metrics.describe('session_tokens_total', 'counter', 'Session tokens issued and checked, by result')
+metrics.describe('pin_pull_wake_seconds', 'histogram', 'Time from /api/sendPin to the waiting pull request waking up')
+metrics.describe('audit_flush_duration_seconds', 'histogram', 'Time to write one batch of audit events')
+metrics.gauge('state_entries', 'Live OTP/PIN store entries by namespace',
+              lambda: {(('namespace', name),): value['size']
+                       for name, value in state_backend.stats().items() if isinstance(value, dict)})
+metrics.gauge('mail_queue_depth', 'Messages waiting for the mail dispatcher',
+              lambda: mail_dispatcher.stats()['queue_depth'])
+metrics.gauge('db_pool_open_connections', 'Open SQLite connections in the pool',
+              lambda: db.pool_stats()['open'])
+metrics.gauge('pin_outbox_pending', 'PIN deliveries waiting for a retry',
+              lambda: pin_outbox.counts().get('pending', 0))
+metrics.gauge('pin_pull_waiters', 'Pull requests waiting for a PIN', pin_mailbox.waiting)
+metrics.gauge('user_cache_entries', 'Cached user ids, including unknown emails',
+              lambda: len(database.user_cache))
+metrics.gauge('audit_events_pending', 'Audit events waiting to be written', audit_log.pending)
+metrics.gauge('audit_events_dropped', 'Audit events dropped because the buffer was full',
+              lambda: audit_log.stats()['dropped'])
+metrics.gauge('log_records_dropped', 'Log records dropped because the log queue was full',
+              logging_setup.dropped_records)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def start_background_work():
+    # Started in the worker rather than at import, so importing the app opens no database
+    # and starts no threads; gunicorn's post_worker_init starts it before the first request
+    pin_outbox.start()  # Picks up deliveries left pending by a previous run
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start, route=route, method=request.method)
+        metrics.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
+# Sampling profiler, off unless PROFILE_SAMPLE_RATE or PROFILE_TRUSTED_IPS is set. Trusted
+# clients profile a single request with an `X-Profile: 1` header and read /api/profile.
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # Fraction of requests profiled, e.g. 0.01
+app.config['PROFILE_TRUSTED_IPS'] = [ip for ip in os.environ.get('PROFILE_TRUSTED_IPS', '').split(',') if ip]
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))  # Seconds between stack samples
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')  # Collapsed stacks per route are written here when set
+
+request_profiler = RequestProfiler(
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    trusted_ips=app.config['PROFILE_TRUSTED_IPS'],
+    interval=app.config['PROFILE_INTERVAL'],
+    output_dir=app.config['PROFILE_DIR'],
+)
+
+if request_profiler.enabled:
+    @app.before_request
+    def start_profile():
+        if request_profiler.wanted(request.remote_addr, request.headers):
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            g.profile = request_profiler.start(f'{request.method} {route}')
+
+    @app.teardown_request
+    def stop_profile(exc):
+        task = g.pop('profile', None)
+        if task is not None:
+            request_profiler.stop(task)
+
+# Rate limits as 'requests/seconds', checked per email and per client IP; empty disables one
+app.config['RATE_LIMIT_LOGIN_EMAIL'] = os.environ.get('RATE_LIMIT_LOGIN_EMAIL', '10/300')
+app.config['RATE_LIMIT_LOGIN_IP'] = os.environ.get('RATE_LIMIT_LOGIN_IP', '30/60')
+app.config['RATE_LIMIT_OTP_EMAIL'] = os.environ.get('RATE_LIMIT_OTP_EMAIL', '5/300')
+app.config['RATE_LIMIT_OTP_IP'] = os.environ.get('RATE_LIMIT_OTP_IP', '20/60')
+app.config['RATE_LIMIT_VERIFY_EMAIL'] = os.environ.get('RATE_LIMIT_VERIFY_EMAIL', '10/300')
+app.config['RATE_LIMIT_FINGERPRINT_EMAIL'] = os.environ.get('RATE_LIMIT_FINGERPRINT_EMAIL', '10/300')
+app.config['RATE_LIMIT_FINGERPRINT_IP'] = os.environ.get('RATE_LIMIT_FINGERPRINT_IP', '30/60')
+
+limiter = RateLimiter(state_backend)
+metrics.describe('rate_limited_total', 'counter', 'Requests rejected with 429 by route and scope')
+
+# Admission control, per process: concurrent requests per expensive route, slots kept free
+# for /api/verifyOtp, and how long a request may queue before it is shed with a 503
+app.config['ADMISSION_CAPACITY'] = int(os.environ.get('ADMISSION_CAPACITY', 16))  # Request threads (or greenlets) of a worker
+app.config['ADMISSION_RESERVED'] = int(os.environ.get('ADMISSION_RESERVED', 2))  # Of those, only for /api/verifyOtp
+app.config['ADMISSION_TARGET'] = float(os.environ.get('ADMISSION_TARGET', 0.005))  # Seconds a request may queue behind a standing queue
+app.config['ADMISSION_INTERVAL'] = float(os.environ.get('ADMISSION_INTERVAL', 0.1))  # Seconds a queue may stay non-empty before it counts as standing
+app.config['ADMISSION_DOWNSTREAM_INTERVAL'] = float(os.environ.get('ADMISSION_DOWNSTREAM_INTERVAL', 1))
+app.config['CONCURRENCY_LOGIN'] = int(os.environ.get('CONCURRENCY_LOGIN', 8))
+app.config['CONCURRENCY_OTP'] = int(os.environ.get('CONCURRENCY_OTP', 8))
+app.config['CONCURRENCY_FINGERPRINT'] = int(os.environ.get('CONCURRENCY_FINGERPRINT', 4))
+app.config['CONCURRENCY_SEND_PIN'] = int(os.environ.get('CONCURRENCY_SEND_PIN', 8))
+app.config['MAIL_DELAY_TARGET'] = float(os.environ.get('MAIL_DELAY_TARGET', 5))  # Seconds the oldest OTP mail may wait before OTP routes shed
+app.config['PIN_DELAY_TARGET'] = float(os.environ.get('PIN_DELAY_TARGET', 2))  # Same for the oldest PIN waiting for the ESP32
+
+admission = AdmissionController(
+    capacity=app.config['ADMISSION_CAPACITY'],
+    reserved=app.config['ADMISSION_RESERVED'],
+    target=app.config['ADMISSION_TARGET'],
+    interval=app.config['ADMISSION_INTERVAL'],
+    downstream_interval=app.config['ADMISSION_DOWNSTREAM_INTERVAL'],
+)
+mail_backlog = (mail_dispatcher.queue_delay, app.config['MAIL_DELAY_TARGET'])
+pin_backlog = (pin_dispatcher.queue_delay, app.config['PIN_DELAY_TARGET'])
+metrics.describe('admission_shed_total', 'counter', 'Requests rejected with 503 by route and reason (queue, downstream)')
+metrics.describe('admission_queue_seconds', 'histogram', 'Time queued requests waited for a slot')
+metrics.gauge('admission_in_flight', 'Requests holding an admission slot', lambda: admission.stats()['in_flight'])
+
+# Request bodies, checked before any database, OTP store or SMTP work. MAX_CONTENT_LENGTH
+# is Flask's own cap on every body; the small JSON routes get a tighter one.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 64 * 1024))  # Bytes, fingerprint templates are the largest
+app.config['REQUEST_MAX_BODY'] = int(os.environ.get('REQUEST_MAX_BODY', 2048))  # Bytes, login/OTP/PIN bodies
+
+LOGIN_BODY = Schema(app.config['REQUEST_MAX_BODY'], email=schemas.email(), password=schemas.string(max_length=1024))
+OTP_REQUEST_BODY = Schema(app.config['REQUEST_MAX_BODY'], email=schemas.email())
+OTP_VERIFY_BODY = Schema(app.config['REQUEST_MAX_BODY'], email=schemas.email(), otp=schemas.digits())
+FINGERPRINT_BODY = Schema(app.config['MAX_CONTENT_LENGTH'], email=schemas.email(required=False),
+                          template=schemas.list_or_string(max_length=app.config['MAX_CONTENT_LENGTH']))
+SEND_PIN_BODY = Schema(app.config['REQUEST_MAX_BODY'], email=schemas.email(required=False), pin=schemas.code(),
+                       deviceId=schemas.string(max_length=64, required=False),
+                       idempotencyKey=schemas.string(max_length=128, required=False))
+metrics.describe('requests_rejected_total', 'counter', 'Request bodies rejected before the view ran, by route and status')
+
+metrics.describe('otp_sends_suppressed_total', 'counter', 'OTP requests answered without sending a mail')
+metrics.describe('otp_reused_total', 'counter', 'OTP requests that re-sent a pending OTP')
+
+def issue_otp(email):
+    # Returns the OTP to mail, or None when one was sent moments ago.
+    # Only the request that takes the cooldown key sends (single-flight across workers).
+    if app.config['OTP_RESEND_COOLDOWN'] and not state_backend.add(state.OTP_COOLDOWN, email, 1):
+        metrics.inc('otp_sends_suppressed_total')
+        return None
+    if totp:
+        return totp.generate(email)  # Nothing to store, stable within a time step anyway
+
+    # A repeated request re-sends the pending code rather than invalidating it
+    if state_backend.get(state.OTP_ISSUED, email):
+        otp = state_backend.get(state.OTP, email)
+        if otp is not None:
+            metrics.inc('otp_reused_total')
+            return otp
+    otp = random.randint(100000, 999999)  # Generate a 6-digit OTP
+    state_backend.set(state.OTP, email, otp)  # Store OTP
+    state_backend.set(state.OTP_ISSUED, email, 1)
+    return otp
+
+def otp_wait(email):
+    # A TOTP code is fixed for its whole step, so once the current one is used mailing it
+    # again is pointless. Seconds until the step rolls over, 0 when a code can be issued.
+    if totp and state_backend.get(state.OTP_USED, f'{email}:{totp.counter()}'):
+        return totp.remaining()
+    return 0
+
+def otp_not_ready(wait):
+    response = jsonify(success=False, message='This OTP was already used, request a new one shortly')
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+def check_otp(email, otp):
+    if totp:
+        counter = totp.verify(email, otp)
+        # Remembering the matched step makes each code single-use
+        return counter is not None and state_backend.add(state.OTP_USED, f'{email}:{counter}', 1)
+    # Removing the OTP is the check, so it can only be used once across all workers
+    return state_backend.pop_if_equal(state.OTP, email, otp)
 
 @app.route('/')  # Route for the root URL
 def home():
     return "Welcome to the Login API! Use /api/login to log in, /api/requestOtp to request an OTP, and /api/sendPin to generate a PIN."
 
 @app.route('/api/login', methods=['POST'])
+@admission.limit('login', app.config['CONCURRENCY_LOGIN'], downstream=mail_backlog)
+@schemas.body('login', LOGIN_BODY)
+@limiter.limit('login', app.config['RATE_LIMIT_LOGIN_EMAIL'], app.config['RATE_LIMIT_LOGIN_IP'])
 def login():
-    data = request.get_json()
+    data = g.body
     email = data.get('email')
     password = data.get('password')
 
-    # Validate the email and password against the database
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE email = ? AND password = ?', (email, password))
-    user = cursor.fetchone()
-    conn.close()
+    # Look the user up by email only (unknown emails cached), the password check runs on the bcrypt pool
+    with metrics.timer('db_query_duration_seconds', query='user_lookup'):
+        user = database.find_user(email)
 
+    matches = False
     if user:
-        otp = random.randint(100000, 999999)  # Generate a 6-digit OTP
-        otp_storage[email] = otp  # Store OTP in memory
-        send_otp(email, otp)  # Send OTP to the user's email
+        with metrics.timer('password_check_duration_seconds'):
+            matches, new_hash = passwords.hasher.check(password, user[1])
+        if new_hash:
+            # Legacy plaintext row or outdated cost, upgrade it transparently
+            database.update_password_hash(user[0], user[1], new_hash)
+    else:
+        with metrics.timer('password_check_duration_seconds'):
+            passwords.hasher.check_missing(password)
+
+    audit_log.record('login', email, 'success' if matches else 'failure', request.remote_addr)
+    if matches:
+        wait = otp_wait(email)
+        if wait:
+            return otp_not_ready(wait)
+        with metrics.timer('otp_issue_duration_seconds'):
+            otp = issue_otp(email)
+        if otp is not None:
+            send_otp(email, otp)  # Send OTP to the user's email
         return jsonify(success=True, message='OTP sent to your email')
     else:
         return jsonify(success=False, message='Invalid email or password'), 401
 
-@app.route('/api/requestOtp', methods=['POST'])
-def request_otp():
-    data = request.get_json()
+@app.route('/api/verifyFingerprint', methods=['POST'])
+@admission.limit('verifyFingerprint', app.config['CONCURRENCY_FINGERPRINT'], downstream=mail_backlog)
+@schemas.body('verifyFingerprint', FINGERPRINT_BODY)
+@limiter.limit('verifyFingerprint', app.config['RATE_LIMIT_FINGERPRINT_EMAIL'], app.config['RATE_LIMIT_FINGERPRINT_IP'])
+def verify_fingerprint():
+    # First step of the home flow: a matching scan sends the OTP. With an email the scan is
+    # compared to that user's template (1:1), without one it is searched among all (1:N).
+    data = g.body
     email = data.get('email')
+    try:
+        vector = parse_template(data.get('template'))
+    except TemplateError as e:
+        return jsonify(success=False, message=str(e)), 400
+
+    threshold = app.config['FINGERPRINT_THRESHOLD']
+    if email:
+        user_id = database.find_user_id(email)
+        with metrics.timer('fingerprint_match_duration_seconds', mode='verify'):
+            score = fingerprint_store.verify(user_id, vector) if user_id is not None else None
+    else:
+        with metrics.timer('fingerprint_match_duration_seconds', mode='identify'):
+            matches = fingerprint_store.identify(vector)
+        score = None
+        if matches and matches[0][1] >= threshold:
+            email = database.email_for(matches[0][0])
+            score = matches[0][1] if email else None
+
+    if score is None or score < threshold:
+        metrics.inc('fingerprint_verifications_total', result='rejected')
+        audit_log.record('fingerprint_verify', email, 'failure', request.remote_addr)
+        logger.warning("Fingerprint not recognised%s", f" for {email}" if email else "")
+        return jsonify(success=False, message='Fingerprint not recognised'), 401
+
+    metrics.inc('fingerprint_verifications_total', result='matched')
+    audit_log.record('fingerprint_verify', email, 'success', request.remote_addr, score=round(score, 3))
+    logger.debug("Fingerprint matched %s with score %.3f", email, score)
+    wait = otp_wait(email)
+    if wait:
+        return otp_not_ready(wait)
+    with metrics.timer('otp_issue_duration_seconds'):
+        otp = issue_otp(email)
+    if otp is not None:
+        send_otp(email, otp)
+    return jsonify(success=True, message='Fingerprint verified, OTP sent to your email', email=email)
+
+@app.route('/api/enrollFingerprint', methods=['POST'])
+@sessions.required
+@schemas.body('enrollFingerprint', FINGERPRINT_BODY)
+def enroll_fingerprint():
+    # Stores the template of the verified user, replacing an earlier one
+    data = g.body
+    try:
+        vector = parse_template(data.get('template'))
+    except TemplateError as e:
+        return jsonify(success=False, message=str(e)), 400
+    user_id = database.find_user_id(g.session_email)
+    if user_id is None:
+        return jsonify(success=False, message='Unknown user'), 404
+    fingerprint_store.enroll(user_id, vector)
+    return jsonify(success=True, message='Fingerprint enrolled')
 
-    if not email:
-        return jsonify(success=False, message='Email is required'), 400
+@app.route('/api/requestOtp', methods=['POST'])
+@admission.limit('requestOtp', app.config['CONCURRENCY_OTP'], downstream=mail_backlog)
+@schemas.body('requestOtp', OTP_REQUEST_BODY)
+@limiter.limit('requestOtp', app.config['RATE_LIMIT_OTP_EMAIL'], app.config['RATE_LIMIT_OTP_IP'])
+def request_otp():
+    data = g.body
+    email = data['email']
 
+    wait = otp_wait(email)
+    if wait:
+        return otp_not_ready(wait)
     # Generate a 6-digit OTP
-    otp = random.randint(100000, 999999)
-    otp_storage[email] = otp  # Store OTP in memory
-    send_otp(email, otp) 
+    with metrics.timer('otp_issue_duration_seconds'):
+        otp = issue_otp(email)
+    if otp is not None:
+        send_otp(email, otp)
     # Send OTP to the user's email
     return jsonify(success=True, message='OTP sent to your email')
 
 def send_otp(email, otp):
-    logging.debug(f"Sending OTP {otp} to {email}")
+    logger.debug("Queueing OTP for %s", email)
     msg = Message('Your OTP Code', recipients=[email])
-    msg.body = f'Your OTP code is {otp}'
-    try:
-        mail.send(msg)
-        logging.info(f"OTP sent successfully to {email}")
-    except Exception as e:
-        logging.error(f"Failed to send OTP: {str(e)}")
-        logging.error("Check your email configuration and credentials.")
+    msg.body = f'Your OTP code is {otp:06d}'
+    # Delivery happens on the mail dispatcher threads, failures are logged there
+    if not mail_dispatcher.submit(msg):
+        logger.error("Failed to queue OTP for %s", email)
 
 @app.route('/api/verifyOtp', methods=['POST'])
+@admission.limit('verifyOtp', priority=True)
+@schemas.body('verifyOtp', OTP_VERIFY_BODY)
+@limiter.limit('verifyOtp', app.config['RATE_LIMIT_VERIFY_EMAIL'])
 def verify_otp():
-    data = request.get_json()
-    email = data.get('email')
-    otp = data.get('otp')
+    data = g.body
+    email = data['email']
+    otp = data['otp']  # Already an int
 
-    logging.debug(f"Received OTP for {email}: {otp}")
-    logging.debug(f"Stored OTP for {email}: {otp_storage.get(email)}")
+    logger.debug("OTP verification requested for %s", email)
 
     # Verify the OTP
-    if email in otp_storage and otp_storage[email] == int(otp):
-        del otp_storage[email]  # Remove OTP after verification
-        logging.info(f"OTP verified successfully for {email}")
-        return jsonify(success=True, message='OTP verified successfully', verified=True)
+    if check_otp(email, otp):
+        # /api/requestOtp mails any address: the code proves control of the email, not an
+        # account, and a token would let sendPin fall back to the default door
+        if database.find_user_id(email) is None:
+            metrics.inc('otp_verifications_total', result='no_account')
+            audit_log.record('otp_verify', email, 'no_account', request.remote_addr)
+            return jsonify(success=False, message='No account for this email', verified=True), 403
+        metrics.inc('otp_verifications_total', result='success')
+        audit_log.record('otp_verify', email, 'success', request.remote_addr)
+        # The code is spent, the next request must get a fresh one straight away
+        state_backend.delete(state.OTP_ISSUED, email)
+        state_backend.delete(state.OTP_COOLDOWN, email)
+        logger.info("OTP verified successfully for %s", email)
+        # Proof of the verification for /api/sendPin, checked by signature alone
+        return jsonify(success=True, message='OTP verified successfully', verified=True,
+                       token=sessions.issue(email), expiresIn=int(app.config['SESSION_TTL']))
     else:
-        logging.warning(f"Invalid OTP attempt for {email}: {otp}")
+        metrics.inc('otp_verifications_total', result='invalid')
+        audit_log.record('otp_verify', email, 'invalid', request.remote_addr)
+        logger.warning("Invalid OTP attempt for %s", email)
         return jsonify(success=False, message='Invalid OTP', verified=False), 400
 
+@app.route('/api/logout', methods=['POST'])
+def logout():
+    sessions.revoke(bearer_token() or '')
+    return jsonify(success=True, message='Logged out')
+
 @app.route('/api/sendPin', methods=['POST'])
+@admission.limit('sendPin', app.config['CONCURRENCY_SEND_PIN'], downstream=pin_backlog)
+@sessions.required
+@schemas.body('sendPin', SEND_PIN_BODY)
 def send_pin():
-    data = request.get_json()
-    logging.debug(f"Received data: {data}")  # Log the incoming data
-    email = data.get('email')
-    pin = data.get('pin')
-
-    if not email or not pin:
-        return jsonify(success=False, message='Email and PIN are required'), 400
-
-    # Store the PIN in memory
-    pin_storage[email] = pin  # Store PIN in memory
-    logging.info(f"Received PIN {pin} for {email}")
-
-    # Send the PIN to NodeMCU ESP32
-    esp32_url = "http://<192.168.1.100>/receivePin"  # Replace with your ESP32's IP address
+    data = g.body
+    email = data.get('email', g.session_email)
+    pin = data['pin']
+
+    if email != g.session_email:
+        return jsonify(success=False, message='Token was issued for another email'), 403
+    device_id = data.get('deviceId')  # Optional, defaults to every device of the user
+
+    devices = device_registry.resolve(email, device_id)
+    if not devices:
+        return jsonify(success=False, message='Unknown device'), 404
+
+    # Store the PIN and its deliveries together, so a PIN is never kept without a way to the door
+    with db.connection() as conn:
+        state_backend.set(state.PIN, email, pin, conn=conn)  # Store PIN
+        keys, existing = pin_outbox.enqueue(conn, email, pin, devices, request_key=data.get('idempotencyKey'))
+    logger.info("Received PIN for %s", email)
+
+    # Send the PIN to the NodeMCU ESP32 devices in the background, all at once
+    delivery, per_device = pin_outbox.deliver(email, pin, devices, keys, wait=app.config['ESP32_DELIVERY_WAIT'])
+    if existing:
+        # A retried request: report the deliveries it already made instead of sending again
+        per_device.update({device_id: ACCEPTED if status in ('pending', 'waiting') else status for device_id, status in existing.items()})
+        delivery = DELIVERED if set(per_device.values()) == {DELIVERED} else ACCEPTED
+    audit_log.record('pin_send', email, delivery, request.remote_addr, devices=per_device)
+    if delivery == DELIVERED:
+        return jsonify(success=True, message='PIN delivered to device', delivery=delivery, devices=per_device)
+    if delivery == ACCEPTED:
+        return jsonify(success=True, message='PIN accepted for delivery', delivery=delivery, devices=per_device), 202
+    # The outbox keeps retrying until the PIN expires
+    return jsonify(success=True, message='Device unreachable, PIN queued for retry', delivery=QUEUED, devices=per_device), 202
+
+def pull_device(device_id):
+    # Pull devices send the token printed by `devices.py add <id> pull` as a bearer token
+    return device_registry.authenticate(device_id, bearer_token())
+
+def too_many_waiters():
+    response = jsonify(success=False, message='Too many devices waiting, try again later')
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.route('/api/devices/<device_id>/pins', methods=['GET'])
+def pull_pins(device_id):
+    # Long-poll: answers as soon as there are PINs for the device, or 204 after ?wait seconds
+    if pull_device(device_id) is None:
+        return jsonify(success=False, message='Unknown device or wrong token'), 401
+    wait = request.args.get('wait', app.config['PIN_PULL_MAX_WAIT'], type=float)
+    if not math.isfinite(wait) or wait <= 0:
+        return jsonify(success=False, message='wait must be a positive number of seconds'), 400
+    deadline = time.monotonic() + min(wait, app.config['PIN_PULL_MAX_WAIT'])
+    while True:
+        since = pin_mailbox.version(device_id)
+        pins = pin_outbox.take(device_id)
+        if pins:
+            return jsonify(pins=pins)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return '', 204
+        try:
+            pin_mailbox.wait(device_id, since, min(remaining, app.config['PIN_PULL_RECHECK']))
+        except TooManyWaiters:
+            return too_many_waiters()
+
+@app.route('/api/devices/<device_id>/events', methods=['GET'])
+def pin_events(device_id):
+    # Server-Sent Events: one 'pin' event per PIN, comment lines as heartbeat
+    if pull_device(device_id) is None:
+        return jsonify(success=False, message='Unknown device or wrong token'), 401
+    if pin_mailbox.waiting() >= pin_mailbox.max_waiters:
+        return too_many_waiters()
+
+    def stream():
+        yield 'retry: 2000\n\n'
+        end = time.monotonic() + app.config['PIN_PULL_STREAM_MAX']
+        last_sent = time.monotonic()
+        while time.monotonic() < end:
+            since = pin_mailbox.version(device_id)
+            for pin in pin_outbox.take(device_id):
+                yield f"id: {pin['key']}\nevent: pin\ndata: {json.dumps(pin)}\n\n"
+                last_sent = time.monotonic()
+            if time.monotonic() - last_sent >= app.config['PIN_PULL_HEARTBEAT']:
+                yield ': heartbeat\n\n'
+                last_sent = time.monotonic()
+            try:
+                pin_mailbox.wait(device_id, since, min(app.config['PIN_PULL_RECHECK'], app.config['PIN_PULL_HEARTBEAT']))
+            except TooManyWaiters:
+                yield 'event: busy\ndata: {}\n\n'
+                return
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/profile', methods=['GET', 'DELETE'])
+def profile():
+    # Collapsed stacks of this worker, e.g. curl .../api/profile?route=POST%20/api/login | flamegraph.pl
+    if request.remote_addr not in request_profiler.trusted_ips:
+        return jsonify(success=False, message='Forbidden'), 403
+    if request.method == 'DELETE':
+        request_profiler.reset()
+        return jsonify(success=True, message='Profile cleared')
+    if request.args.get('format') == 'json':
+        return jsonify(request_profiler.stats())
+    return Response(request_profiler.collapsed(request.args.get('route')), content_type='text/plain; charset=utf-8')
+
+@app.route('/api/dbPoolStats', methods=['GET'])
+def db_pool_stats():
+    return jsonify(db.pool_stats())
+
+@app.route('/api/mailStats', methods=['GET'])
+def mail_stats():
+    return jsonify(mail_dispatcher.stats())
+
+@app.route('/api/pinStats', methods=['GET'])
+def pin_stats():
+    if request.remote_addr not in app.config['DEVICE_ADMIN_TRUSTED_IPS']:
+        return jsonify(success=False, message='Forbidden'), 403
+    return jsonify(pin_dispatcher.stats())
+
+@app.route('/api/deviceStats', methods=['GET'])
+def device_stats():
+    if request.remote_addr not in app.config['DEVICE_ADMIN_TRUSTED_IPS']:
+        return jsonify(success=False, message='Forbidden'), 403
+    devices = [{k: v for k, v in device._asdict().items() if k != 'token_hash'} for device in device_registry.all()]
+    return jsonify(dict(device_registry.stats(), devices=devices, pull=pin_mailbox.stats()))
+
+@app.route('/api/pinOutbox', methods=['GET'])
+def pin_outbox_entries():
+    # Admin view of recent deliveries, e.g. ?status=pending or ?status=failed
+    if request.remote_addr not in app.config['DEVICE_ADMIN_TRUSTED_IPS']:
+        return jsonify(success=False, message='Forbidden'), 403
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    return jsonify(stats=pin_outbox.stats(), deliveries=pin_outbox.entries(request.args.get('status'), limit))
+
+@app.route('/api/pinOutbox/<key>/retry', methods=['POST'])
+def pin_outbox_retry(key):
+    if request.remote_addr not in app.config['DEVICE_ADMIN_TRUSTED_IPS']:
+        return jsonify(success=False, message='Forbidden'), 403
+    if pin_outbox.retry(key):
+        return jsonify(success=True, message='Delivery queued again')
+    return jsonify(success=False, message='No failed delivery with a valid PIN for that key'), 404
+
+@app.route('/api/userCacheStats', methods=['GET'])
+def user_cache_stats():
+    return jsonify(database.user_cache.stats())
+
+@app.route('/api/fingerprintStats', methods=['GET'])
+def fingerprint_stats():
+    return jsonify(fingerprint_store.stats())
+
+@app.route('/api/auditLog', methods=['GET'])
+@sessions.required
+def audit_history():
+    # The caller's own events, newest first; pass `next` back as ?before= for the following page
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
     try:
-        response = requests.post(esp32_url, json={'email': email, 'pin': pin})
-        if response.status_code == 200:
-            logging.info(f"PIN {pin} sent to ESP32 successfully.")
-        else:
-            logging.error(f"Failed to send PIN to ESP32: {response.text}")
-    except Exception as e:
-        logging.error(f"Error sending PIN to ESP32: {str(e)}")
-
-    return jsonify(success=True, message='PIN received successfully')
-
-def expire_pin(email):
-    if email in pin_storage:
-        del pin_storage[email]  # Remove PIN after expiration
-        logging.info(f"PIN for {email} has expired and has been removed.")
+        events, cursor = audit_log.history(g.session_email, limit, request.args.get('before'))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    return jsonify(events=events, next=cursor)
+
+@app.route('/api/auditStats', methods=['GET'])
+def audit_stats():
+    return jsonify(audit_log.stats())
+
+@app.route('/api/admissionStats', methods=['GET'])
+def admission_stats():
+    return jsonify(dict(admission.stats(), mail_queue_delay=mail_dispatcher.queue_delay(),
+                        pin_queue_delay=pin_dispatcher.queue_delay()))
+
+@app.route('/api/storeStats', methods=['GET'])
+def store_stats():
+    return jsonify(state_backend.stats())
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,221 @@
+# Write-behind audit log of logins, OTP checks and PIN deliveries.
+#
+# Request threads append events to an in-memory ring buffer; a background thread writes
+# them to SQLite in one transaction per batch. A crash loses at most the events of the
+# last flush_interval seconds, and a writer that falls behind loses the oldest buffered
+# events (counted in `dropped`) rather than slowing requests down.
+#
+# Events go into one table per UTC day (audit_events_YYYYMMDD), so retention pruning
+# drops whole tables instead of deleting rows one by one.
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_PARTITION = re.compile(r'^audit_events_(\d{8})$')
+PRUNE_INTERVAL = 3600.0  # Seconds between retention passes
+
+
+def partition_for(ts):
+    return time.strftime('%Y%m%d', time.gmtime(ts))
+
+
+class AuditLog:
+    def __init__(self, max_buffer=10000, batch_size=500, flush_interval=1.0, retention_days=90):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._partitions = None  # Day strings with a table, loaded lazily
+        self._pid = None
+        self._last_prune = 0.0
+        self._recorded = 0
+        self._written = 0
+        self._dropped = 0
+        self._batches = 0
+        self._write_time = 0.0
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # The writer thread does not survive a fork, every worker runs its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._buffer = deque(maxlen=self._buffer.maxlen)  # The parent's events are the parent's to write
+            threading.Thread(target=self._run, name='audit-writer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def record(self, event, email=None, outcome=None, ip=None, **detail):
+        self._ensure_started()
+        entry = (time.time(), event, email, outcome, ip, json.dumps(detail) if detail else None)
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._dropped += 1  # The deque pushes the oldest event out
+            self._buffer.append(entry)
+            self._recorded += 1
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                self._maybe_prune()
+            except Exception:
+                logger.exception("Audit log write failed")
+
+    def _tables(self, conn, refresh=False):
+        # Days that have a table; refresh to see the ones other workers created
+        if self._partitions is None or refresh:
+            rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'audit_events_%'")
+            partitions = {m.group(1) for (name,) in rows for m in [_PARTITION.match(name)] if m}
+            with self._lock:
+                self._partitions = partitions
+        with self._lock:
+            return set(self._partitions)
+
+    def _ensure_partition(self, conn, day):
+        # Partitions are made here rather than in migrations.py: one table per day
+        if day in self._tables(conn):
+            return
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS audit_events_{day} (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                event TEXT NOT NULL,
+                email TEXT,
+                outcome TEXT,
+                ip TEXT,
+                detail TEXT
+            )
+        ''')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_audit_events_{day}_email ON audit_events_{day} (email, id)')
+        with self._lock:
+            self._partitions.add(day)
+
+    def flush(self):
+        # Writes everything buffered so far; returns the number of events written
+        written = 0
+        while True:
+            with self._lock:
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            if not batch:
+                return written
+            by_day = {}
+            for entry in batch:
+                by_day.setdefault(partition_for(entry[0]), []).append(entry)
+            start = time.perf_counter()
+            try:
+                with db.connection() as conn:
+                    for day, entries in by_day.items():
+                        self._ensure_partition(conn, day)
+                        conn.executemany(
+                            f'INSERT INTO audit_events_{day} (ts, event, email, outcome, ip, detail) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            entries,
+                        )
+            except Exception:
+                with self._lock:
+                    self._buffer.extendleft(reversed(batch))  # Try again next round, the ring bound still holds
+                raise
+            elapsed = time.perf_counter() - start
+            metrics.observe('audit_flush_duration_seconds', elapsed)
+            with self._lock:
+                self._written += len(batch)
+                self._batches += 1
+                self._write_time += elapsed
+            written += len(batch)
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        self.prune(now)
+
+    def prune(self, now=None):
+        # Drops the day tables that are entirely older than the retention period
+        cutoff = partition_for((now or time.time()) - self.retention_days * 86400)
+        with db.connection() as conn:
+            old = sorted(day for day in self._tables(conn, refresh=True) if day < cutoff)
+            for day in old:
+                conn.execute(f'DROP TABLE IF EXISTS audit_events_{day}')
+                with self._lock:
+                    self._partitions.discard(day)
+        if old:
+            logger.info("Dropped %d audit partition(s) older than %s", len(old), cutoff)
+        return len(old)
+
+    def history(self, email, limit=50, before=None):
+        # Newest first. `before` is the cursor returned with the previous page, 'YYYYMMDD:id'.
+        # Returns (events, cursor for the next page or None); ValueError for a bad cursor.
+        before_day, before_id = None, None
+        if before:
+            before_day, _, before_id = before.partition(':')
+            if not (before_day.isdigit() and len(before_day) == 8 and before_id.isdigit()):
+                raise ValueError(f"Bad cursor: {before}")
+            before_id = int(before_id)
+        events = []
+        with db.connection() as conn:
+            days = sorted(self._tables(conn, refresh=True), reverse=True)
+            for day in days:
+                if before_day and day > before_day:
+                    continue
+                query = f'SELECT id, ts, event, outcome, ip, detail FROM audit_events_{day} WHERE email = ?'
+                params = [email]
+                if day == before_day:
+                    query += ' AND id < ?'
+                    params.append(before_id)
+                query += ' ORDER BY id DESC LIMIT ?'
+                params.append(limit - len(events) + 1)  # One extra row tells whether there is a next page
+                for row_id, ts, event, outcome, ip, detail in conn.execute(query, params):
+                    events.append({
+                        'cursor': f'{day}:{row_id}', 'ts': ts, 'event': event, 'outcome': outcome, 'ip': ip,
+                        'detail': json.loads(detail) if detail else None,
+                    })
+                if len(events) > limit:
+                    break
+        cursor = events[limit - 1]['cursor'] if len(events) > limit else None
+        return events[:limit], cursor
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def stats(self):
+        with self._lock:
+            batches = self._batches
+            return {
+                'recorded': self._recorded,
+                'written': self._written,
+                'pending': len(self._buffer),
+                'dropped': self._dropped,
+                'batches': batches,
+                'avg_batch_size': self._written / batches if batches else 0.0,
+                'avg_flush_ms': self._write_time / batches * 1000 if batches else 0.0,
+                'partitions': len(self._partitions or ()),
+            }
+
+    def close(self):
+        # Runs at exit so a clean shutdown loses nothing
+        if self._pid == os.getpid():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Audit log flush at exit failed")
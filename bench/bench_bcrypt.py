@@ -0,0 +1,53 @@
+# Measures bcrypt login checks per second through the PasswordHasher pool.
+#
+#   python bench/bench_bcrypt.py --rounds 12 --seconds 5
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher, hash_password  # noqa: E402
+
+
+def run(workers, rounds, seconds):
+    hasher = PasswordHasher(workers=workers, rounds=rounds)
+    stored = hash_password('correct horse', rounds)
+    done = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    # One client thread per pool slot, like that many concurrent /api/login requests
+    def client():
+        nonlocal done
+        while time.perf_counter() < deadline:
+            matches, _ = hasher.check('correct horse', stored)
+            assert matches
+            with lock:
+                done += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return done / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='bcrypt login throughput')
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--workers', type=int, nargs='*', default=None)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, max(1, cores // 2), cores})
+    print(f"bcrypt cost {args.rounds}, {cores} core(s)")
+    print(f"{'workers':>8} {'logins/s':>10} {'per core':>10} {'ms/login':>10}")
+    for workers in worker_counts:
+        rate = run(workers, args.rounds, args.seconds)
+        print(f"{workers:>8} {rate:>10.1f} {rate / min(workers, cores):>10.1f} {workers / rate * 1000:>10.1f}")
@@ -0,0 +1,75 @@
+# Measures fingerprint matching throughput against a store of random enrolled templates.
+#
+#   python bench/bench_fingerprint.py --users 100000 --seconds 3
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from fingerprints import FingerprintStore, DIM  # noqa: E402
+
+
+def unit(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def noisy(vector, rng, noise):
+    # A second scan of the same finger: the enrolled vector plus sensor noise
+    return unit(vector + rng.normal(0, noise, vector.shape).astype(np.float32))
+
+
+def rate(seconds, call):
+    done = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        done += call()
+    return done / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fingerprint matching throughput')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--batch-size', type=int, default=16384, help='Templates scored per block')
+    parser.add_argument('--probes', type=int, default=32, help='Probes per identify_many call')
+    parser.add_argument('--noise', type=float, default=0.02)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    workdir = tempfile.mkdtemp(prefix='esss-fp-')
+    db.DB_PATH = os.path.join(workdir, 'users.db')
+    store = FingerprintStore(os.path.join(workdir, 'fingerprints.npy'), batch_size=args.batch_size)
+
+    templates = unit(rng.standard_normal((args.users, DIM), dtype=np.float32))
+    start = time.perf_counter()
+    store.enroll_many((user_id, templates[user_id - 1]) for user_id in range(1, args.users + 1))
+    size = os.path.getsize(store.path)
+    print(f"Enrolled {args.users} templates of {DIM} values in {time.perf_counter() - start:.1f}s "
+          f"({size / 2**20:.1f} MiB on disk)")
+
+    user_ids = rng.integers(1, args.users + 1, size=1024)
+    probes = np.stack([noisy(templates[u - 1], rng, args.noise) for u in user_ids])
+
+    found = [store.identify(p)[0][0] for p in probes[:64]]
+    correct = sum(f == u for f, u in zip(found, user_ids[:64]))
+    print(f"1:N accuracy on {len(found)} noisy probes: {correct}/{len(found)}, "
+          f"genuine score {store.verify(int(user_ids[0]), probes[0]):.3f}, "
+          f"impostor score {store.verify(int(user_ids[1]), probes[0]):.3f}")
+
+    i = iter(range(10**12))
+    verify_rate = rate(args.seconds, lambda: store.verify(int(user_ids[next(i) % 1024]), probes[0]) is not None)
+    identify_rate = rate(args.seconds, lambda: len(store.identify(probes[next(i) % 1024])))
+    batch = probes[:args.probes]
+    batch_rate = rate(args.seconds, lambda: len(store.identify_many(batch)))
+
+    print(f"{'mode':<28} {'probes/s':>10} {'comparisons/s':>15}")
+    print(f"{'1:1 verify':<28} {verify_rate:>10.0f} {verify_rate:>15.3g}")
+    print(f"{'1:N identify':<28} {identify_rate:>10.1f} {identify_rate * args.users:>15.3g}")
+    print(f"{f'1:N identify_many x{args.probes}':<28} {batch_rate:>10.1f} {batch_rate * args.users:>15.3g}")
@@ -0,0 +1,87 @@
+# Measures what it costs a gunicorn worker to boot: importing app.py in a fresh
+# interpreter, whether the import already opens the database, and the first request
+# after it. With --fork the app is imported once and each worker is a fork of that
+# process, as with gunicorn's preload_app.
+#
+#   python bench/bench_startup.py --runs 10
+#   python bench/bench_startup.py --runs 10 --repo /path/to/other/checkout
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the child interpreter; prints one JSON line
+PROBE = r'''
+import json, os, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+import db
+opened = db._pool is not None  # Did importing the app already open the database?
+
+def first_request():
+    t = time.perf_counter()
+    # An unknown email: a user lookup, so the database is opened, and a dummy bcrypt check
+    # (cheap at BCRYPT_ROUNDS=4), but no mail
+    response = app.app.test_client().post('/api/login', json={'email': 'bench@example.com', 'password': 'x'})
+    assert response.status_code == 401, response.status_code
+    return time.perf_counter() - t
+
+if os.environ.get('BENCH_FORK'):
+    read, write = os.pipe()
+    t = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        first_request()
+        os.write(write, b'x')
+        os._exit(0)
+    os.read(read, 1)
+    worker = time.perf_counter() - t
+    os.waitpid(pid, 0)
+    print(json.dumps({'import': imported - start, 'opened': opened, 'worker': worker}))
+else:
+    request = first_request()
+    print(json.dumps({'import': imported - start, 'opened': opened, 'worker': imported - start + request}))
+sys.stdout.flush()
+os._exit(0)  # Skip atexit flushes, they are not part of booting
+'''
+
+
+def probe(repo, db_path, fork):
+    env = dict(os.environ, DB_PATH=db_path, SESSION_SECRET_KEYS='bench', LOG_LEVEL='ERROR',
+               BCRYPT_ROUNDS='4', PYTHONDONTWRITEBYTECODE='1')
+    if fork:
+        env['BENCH_FORK'] = '1'
+    env.pop('PROFILE_SAMPLE_RATE', None)
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=repo, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def report(label, results):
+    imports = [r['import'] * 1000 for r in results]
+    workers = [r['worker'] * 1000 for r in results]
+    opened = sum(r['opened'] for r in results)
+    print(f"{label:<34} {statistics.median(imports):>10.1f} {statistics.median(workers):>14.1f} "
+          f"{f'{opened}/{len(results)}':>22}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Worker boot cost')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--repo', default=ROOT, help='Checkout to measure, defaults to this one')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='esss-startup-')
+    print(f"{'boot':<34} {'import ms':>10} {'to 1st resp ms':>14} {'db opened at import':>22}")
+    fresh = [probe(args.repo, os.path.join(workdir, f'fresh-{i}.db'), False) for i in range(args.runs)]
+    report('fresh interpreter, new database', fresh)
+    shared = os.path.join(workdir, 'shared.db')
+    existing = [probe(args.repo, shared, False) for _ in range(args.runs)]
+    report('fresh interpreter, existing db', existing)
+    forked = [probe(args.repo, shared, True) for _ in range(args.runs)]
+    report('forked from an imported app', forked)
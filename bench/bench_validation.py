@@ -0,0 +1,82 @@
+# Measures the cost of decoding and validating one request body, per route schema,
+# with the stdlib json module and with orjson when it is installed.
+#
+#   python bench/bench_validation.py --seconds 1
+#
+# Columns: microseconds to decode and validate a body with each decoder, then to
+# validate an already decoded body alone.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schemas  # noqa: E402
+from schemas import Schema, SchemaError  # noqa: E402
+
+LOGIN = Schema(2048, email=schemas.email(), password=schemas.string(max_length=1024))
+VERIFY = Schema(2048, email=schemas.email(), otp=schemas.digits())
+SEND_PIN = Schema(2048, email=schemas.email(required=False), pin=schemas.code(),
+                  deviceId=schemas.string(max_length=64, required=False),
+                  idempotencyKey=schemas.string(max_length=128, required=False))
+FINGERPRINT = Schema(65536, email=schemas.email(required=False), template=schemas.list_or_string(max_length=65536))
+
+CASES = [
+    ('login', LOGIN, {'email': 'user1@example.com', 'password': 'correct horse battery'}),
+    ('verifyOtp', VERIFY, {'email': 'user1@example.com', 'otp': '012345'}),
+    ('verifyOtp (bad otp)', VERIFY, {'email': 'user1@example.com', 'otp': 'abc'}),
+    ('sendPin', SEND_PIN, {'pin': '1234', 'deviceId': 'front-door', 'idempotencyKey': 'a' * 32}),
+    ('fingerprint (list)', FINGERPRINT, {'template': [0.0625] * 256}),
+]
+
+
+def rate(seconds, call):
+    done = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            call()
+        done += 100
+    return done / (time.perf_counter() - start)
+
+
+def parse(schema, body):
+    try:
+        schema.parse(body)
+    except SchemaError:
+        pass
+
+
+def parse_decoded(schema, data):
+    try:
+        schema.validate(data)
+    except SchemaError:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Request body parse+validate cost')
+    parser.add_argument('--seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    decoders = [('json', json.loads)]
+    if schemas.orjson is not None:
+        decoders.append(('orjson', schemas.orjson.loads))
+    else:
+        print("orjson is not installed, measuring the stdlib decoder only")
+
+    print(f"{'body':<22} {'bytes':>6} " + ' '.join(f"{name + ' us':>10}" for name, _ in decoders)
+          + f" {'validate us':>12}")
+    for label, schema, data in CASES:
+        body = json.dumps(data).encode()
+        costs = []
+        for _, decoder in decoders:
+            schemas.loads = decoder
+            costs.append(1e6 / rate(args.seconds, lambda: parse(schema, body)))
+        decoded = json.loads(body)
+        validate = 1e6 / rate(args.seconds, lambda: parse_decoded(schema, decoded))
+        print(f"{label:<22} {len(body):>6} " + ' '.join(f"{cost:>10.2f}" for cost in costs) + f" {validate:>12.2f}")
+
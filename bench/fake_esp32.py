@@ -0,0 +1,87 @@
+# Stand-in for the ESP32 /receivePin endpoint with configurable latency and failure rate.
+#
+#   python bench/fake_esp32.py --port 8090 --latency 0.05 --failure-rate 0.1
+# then run the app with ESP32_URL=http://127.0.0.1:8090/receivePin
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeESP32Server(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, failure_rate=0.0):
+        super().__init__(address, _ESP32Handler)
+        self.latency = latency  # Seconds before answering
+        self.failure_rate = failure_rate  # Fraction of requests answered with a 500
+        self.received = []
+        self.duplicates = 0
+        self._seen_keys = set()
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid-request are expected when a test run stops
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _ESP32Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real device
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            self._reply(500, b'simulated failure')
+            return
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self._reply(400, b'bad json')
+            return
+        with self.server.lock:
+            # Like the firmware, a repeated idempotency key is acknowledged but not acted on
+            key = payload.get('idempotencyKey')
+            if key in self.server._seen_keys:
+                self.server.duplicates += 1
+            else:
+                if key:
+                    self.server._seen_keys.add(key)
+                self.server.received.append(payload)
+        self._reply(200, b'OK')
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0):
+    server = FakeESP32Server((host, port), latency=latency, failure_rate=failure_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake ESP32 PIN receiver')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeESP32Server((args.host, args.port), latency=args.latency, failure_rate=args.failure_rate)
+    logging.info(f"Fake ESP32 listening on http://{args.host}:{args.port}/receivePin")
+    server.serve_forever()
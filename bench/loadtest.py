@@ -0,0 +1,275 @@
+# End-to-end load test of /api/login -> /api/verifyOtp -> /api/sendPin.
+#
+# Starts the app in a subprocess against a throwaway database, a stub SMTP server that
+# captures the OTP mails and a fake ESP32, then drives concurrent virtual users through
+# the whole flow and reports latency percentiles and throughput per endpoint.
+#
+#   python bench/loadtest.py --users 20 --duration 30 --save bench/baseline.json
+#   python bench/loadtest.py --users 20 --duration 30 --compare bench/baseline.json
+import argparse
+import email
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import fake_esp32  # noqa: E402
+import stub_smtp  # noqa: E402
+
+ENDPOINTS = ('/api/login', '/api/verifyOtp', '/api/sendPin')
+PASSWORD = 'load-test-password'
+
+
+class OtpInbox:
+    # Collects OTPs from the stub SMTP server, one waiting slot per recipient
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._codes = {}
+
+    def on_message(self, mail_from, rcpt_to, data):
+        message = email.message_from_bytes(data)
+        part = next((p for p in message.walk() if p.get_content_type() == 'text/plain'), message)
+        match = re.search(rb'(\d{6})', part.get_payload(decode=True) or b'')
+        if not match:
+            return
+        with self._cond:
+            for rcpt in rcpt_to:
+                self._codes[rcpt.strip('<>')] = match.group(1).decode()
+            self._cond.notify_all()
+
+    def wait(self, address, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while address not in self._codes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._codes.pop(address)
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.flows = 0
+        self.otp_timeouts = 0
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def seed_users(workdir, count, rounds):
+    # Runs in a child process so the app modules pick up the throwaway database
+    code = (
+        'import database, bulk_import, passwords\n'
+        f'hasher = passwords.PasswordHasher(rounds={rounds})\n'
+        f'rows = ((i, f"load{{i}}@example.com", {PASSWORD!r}) for i in range({count}))\n'
+        'bulk_import.import_users(rows, hasher=hasher)\n'
+    )
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, BCRYPT_ROUNDS=str(rounds))
+    subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_app(workdir, port, args, smtp_port, esp32_port):
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_DIR,
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=str(smtp_port),
+        MAIL_USE_TLS='0',
+        MAIL_USERNAME='otp@example.com',
+        MAIL_PASSWORD='stub',
+        ESP32_URL=f'http://127.0.0.1:{esp32_port}/receivePin',
+        BCRYPT_ROUNDS=str(args.bcrypt_rounds),
+        # Virtual users log in far more often than real ones, keep the limits out of the way
+        RATE_LIMIT_LOGIN_EMAIL='',
+        RATE_LIMIT_LOGIN_IP='',
+        RATE_LIMIT_OTP_EMAIL='',
+        RATE_LIMIT_OTP_IP='',
+        RATE_LIMIT_VERIFY_EMAIL='',
+        SESSION_SECRET_KEYS='loadtest-session-key',  # Shared by all workers
+    )
+    if args.workers > 1:
+        env.setdefault('STATE_BACKEND', 'sqlite')  # OTPs must be visible to every worker
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-k', args.worker_class,
+                   '-b', f'127.0.0.1:{port}', 'app:app']
+        if args.worker_class == 'gthread':
+            command[-1:-1] = ['--threads', str(args.threads)]
+    else:
+        command = [sys.executable, '-c',
+                   f'import app; app.app.run(host="127.0.0.1", port={port}, threaded=True)']
+    log = open(os.path.join(workdir, 'app.log'), 'w')
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup, see {log.name}")
+        try:
+            requests.get(f'http://127.0.0.1:{port}/', timeout=1)
+            return process
+        except requests.RequestException:  # Refused, or accepted but not answered yet
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("App did not start within 30s")
+
+
+def virtual_user(index, base_url, inbox, results, deadline, otp_timeout):
+    session = requests.Session()
+    address = f'load{index}@example.com'
+
+    def post(endpoint, payload, token=None):
+        start = time.perf_counter()
+        headers = {'Authorization': f'Bearer {token}'} if token else None
+        try:
+            response = session.post(base_url + endpoint, json=payload, headers=headers, timeout=30)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        results.record(endpoint, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    while time.monotonic() < deadline:
+        if post('/api/login', {'email': address, 'password': PASSWORD}) is None:
+            continue
+        otp = inbox.wait(address, otp_timeout)
+        if otp is None:
+            with results._lock:
+                results.otp_timeouts += 1
+            continue
+        verified = post('/api/verifyOtp', {'email': address, 'otp': otp})
+        if verified is None:
+            continue
+        if post('/api/sendPin', {'email': address, 'pin': f'{index % 10000:04d}'}, verified.json()['token']) is None:
+            continue
+        with results._lock:
+            results.flows += 1
+
+
+def summarize(results, elapsed):
+    summary = {'duration': elapsed, 'flows': results.flows, 'flows_per_second': results.flows / elapsed,
+               'otp_timeouts': results.otp_timeouts, 'endpoints': {}}
+    for endpoint in ENDPOINTS:
+        values = sorted(results.latencies[endpoint])
+        summary['endpoints'][endpoint] = {
+            'requests': len(values),
+            'errors': results.errors[endpoint],
+            'rps': len(values) / elapsed,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+        }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print(f"{summary['flows']} complete flows in {summary['duration']:.1f}s "
+          f"({summary['flows_per_second']:.1f}/s), {summary['otp_timeouts']} OTP timeouts")
+    print(f"{'endpoint':<16} {'reqs':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, row in summary['endpoints'].items():
+        print(f"{endpoint:<16} {row['requests']:>7} {row['errors']:>7} {row['rps']:>8.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+        if baseline and endpoint in baseline['endpoints']:
+            base = baseline['endpoints'][endpoint]
+            deltas = []
+            for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if base[key]:
+                    deltas.append(f"{key} {(row[key] - base[key]) / base[key] * 100:+.1f}%")
+            print(f"{'':<16} vs baseline: {', '.join(deltas)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end load test')
+    parser.add_argument('--users', type=int, default=10, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run')
+    parser.add_argument('--server', choices=('flask', 'gunicorn'), default='flask')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--worker-class', choices=('sync', 'gthread', 'gevent'), default='gthread',
+                        help='gunicorn worker class, gevent matches SERVER_MODE=async')
+    parser.add_argument('--bcrypt-rounds', type=int, default=10)
+    parser.add_argument('--smtp-latency', type=float, default=0.0)
+    parser.add_argument('--esp32-latency', type=float, default=0.0)
+    parser.add_argument('--esp32-failure-rate', type=float, default=0.0)
+    parser.add_argument('--otp-timeout', type=float, default=30.0)
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare against results saved with --save')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='esss-loadtest-')
+    inbox = OtpInbox()
+    smtp = stub_smtp.start(latency=args.smtp_latency, on_message=inbox.on_message)
+    esp32 = fake_esp32.start(latency=args.esp32_latency, failure_rate=args.esp32_failure_rate)
+    process = None
+    try:
+        seed_users(workdir, args.users, args.bcrypt_rounds)
+        port = free_port()
+        process = start_app(workdir, port, args, smtp.server_address[1], esp32.server_address[1])
+
+        results = Results()
+        deadline = time.monotonic() + args.duration
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=virtual_user,
+                             args=(i, f'http://127.0.0.1:{port}', inbox, results, deadline, args.otp_timeout))
+            for i in range(args.users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = summarize(results, time.perf_counter() - start)
+        summary['config'] = {k: v for k, v in vars(args).items() if k not in ('save', 'compare', 'keep')}
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(10)
+        smtp.shutdown()
+        esp32.shutdown()
+        if args.keep:
+            print(f"Working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,103 @@
+# Minimal SMTP server for local testing. Accepts any login, never does STARTTLS
+# and keeps every received message in memory.
+#
+# Start it with `python bench/stub_smtp.py`, then run the app against it with:
+#   MAIL_SERVER=127.0.0.1 MAIL_PORT=8025 MAIL_USE_TLS=0 MAIL_USERNAME=otp@example.com python app.py
+import argparse
+import logging
+import socketserver
+import sys
+import threading
+import time
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, on_message=None):
+        super().__init__(address, _SMTPHandler)
+        self.latency = latency  # Seconds added before accepting each message
+        self.on_message = on_message
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid-request are expected when a test run stops
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def deliver(self, mail_from, rcpt_to, data):
+        with self.lock:
+            self.messages.append((mail_from, rcpt_to, data))
+        if self.on_message is not None:
+            self.on_message(mail_from, rcpt_to, data)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 stub ESMTP ready')
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-stub\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+            elif verb == 'HELO':
+                self.reply('250 stub')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = command[10:].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt_to.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                chunks = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk == b'.\r\n':
+                        break
+                    chunks.append(chunk)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                self.server.deliver(mail_from, rcpt_to, b''.join(chunks))
+                self.reply('250 OK queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+def start(host='127.0.0.1', port=0, latency=0.0, on_message=None):
+    server = StubSMTPServer((host, port), latency=latency, on_message=on_message)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stub SMTP server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = StubSMTPServer((args.host, args.port), latency=args.latency,
+                            on_message=lambda f, t, d: logging.info(f"Captured mail for {t}"))
+    logging.info(f"Stub SMTP server listening on {args.host}:{args.port}")
+    server.serve_forever()
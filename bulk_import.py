@@ -0,0 +1,136 @@
+# Streaming bulk user import.
+#
+#   python bulk_import.py employees.csv --rejects rejects.csv
+#
+# CSV files need an 'email,password' header; JSONL files hold one
+# {"email": ..., "password": ...} object per line. Rows are read lazily and written
+# in large transactions, so memory use depends on the batch size, not the file size.
+import argparse
+import csv
+import itertools
+import json
+import logging
+import time
+
+import db
+import passwords
+
+logger = logging.getLogger(__name__)
+
+INSERT_SQL = 'INSERT INTO users (email, password) VALUES (?, ?) ON CONFLICT (email) DO NOTHING'
+
+
+def read_csv(f):
+    for line_no, row in enumerate(csv.DictReader(f), start=2):
+        yield line_no, row.get('email'), row.get('password')
+
+
+def read_jsonl(f):
+    for line_no, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_no, None, None
+            continue
+        if not isinstance(row, dict):
+            yield line_no, None, None
+            continue
+        yield line_no, row.get('email'), row.get('password')
+
+
+def read_rows(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = read_jsonl if path.endswith(('.jsonl', '.ndjson')) else read_csv
+        yield from reader(f)
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_users(rows, batch_size=1000, hasher=passwords.hasher, on_reject=None):
+    # rows: iterable of (line_no, email, password). on_reject(line_no, email, reason)
+    # is called for every row that is not inserted. Returns import statistics.
+    stats = {'read': 0, 'inserted': 0, 'rejected': 0}
+    start = time.perf_counter()
+
+    def reject(line_no, email, reason):
+        stats['rejected'] += 1
+        if on_reject is not None:
+            on_reject(line_no, email, reason)
+
+    for batch in _batches(rows, batch_size):
+        stats['read'] += len(batch)
+
+        # Drop malformed rows and duplicates within the batch
+        candidates = {}
+        for line_no, email, password in batch:
+            email = email.strip() if isinstance(email, str) else None
+            if not email or '@' not in email or not isinstance(password, str) or not password:
+                reject(line_no, email, 'invalid')
+            elif email in candidates:
+                reject(line_no, email, 'duplicate')
+            else:
+                candidates[email] = (line_no, password)
+
+        # One query finds existing users, so no bcrypt time is spent on them
+        if candidates:
+            placeholders = ','.join('?' * len(candidates))
+            with db.connection() as conn:
+                existing = conn.execute(
+                    f'SELECT email FROM users WHERE email IN ({placeholders})', list(candidates)
+                ).fetchall()
+            for (email,) in existing:
+                reject(candidates.pop(email)[0], email, 'exists')
+
+        if candidates:
+            emails = list(candidates)
+            hashes = hasher.hash_many([candidates[email][1] for email in emails])
+            lost = []
+            with db.connection() as conn:
+                # One transaction still, the statement is prepared once; a row count of 0
+                # means the email was inserted by someone else since the check above
+                for email, password_hash in zip(emails, hashes):
+                    if not conn.execute(INSERT_SQL, (email, password_hash)).rowcount:
+                        lost.append(email)
+            stats['inserted'] += len(emails) - len(lost)
+            for email in lost:
+                reject(candidates[email][0], email, 'exists')
+
+        elapsed = time.perf_counter() - start
+        logger.info("Imported %d of %d rows (%.0f rows/s)", stats['inserted'], stats['read'], stats['read'] / elapsed)
+
+    elapsed = time.perf_counter() - start
+    stats['seconds'] = elapsed
+    stats['rows_per_second'] = stats['read'] / elapsed if elapsed else 0.0
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import users from CSV or JSONL')
+    parser.add_argument('path')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--rejects', help='Write rejected rows to this CSV file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rejects_file = open(args.rejects, 'w', newline='') if args.rejects else None
+    on_reject = None
+    if rejects_file:
+        writer = csv.writer(rejects_file)
+        writer.writerow(['line', 'email', 'reason'])
+        on_reject = lambda line_no, email, reason: writer.writerow([line_no, email, reason])  # noqa: E731
+
+    try:
+        result = import_users(read_rows(args.path), batch_size=args.batch_size, on_reject=on_reject)
+    finally:
+        if rejects_file:
+            rejects_file.close()
+    print(json.dumps(result, indent=2))
@@ -1,50 +1,80 @@
-import sqlite3
+import os
 
-def create_connection():
-    conn = sqlite3.connect('users.db')
-    return conn
+import db
+import passwords
+from user_cache import UserCache
 
-def create_table():
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    conn.close()
+user_cache = UserCache(
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 300)),  # Seconds a known email's id is kept
+    negative_ttl=float(os.environ.get('USER_CACHE_NEGATIVE_TTL', 30)),  # Seconds an unknown email stays unknown
+)
 
 def insert_user(email, password):
-    conn = create_connection()
-    cursor = conn.cursor()
-    
-    # Check if the email already exists
-    cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-    existing_user = cursor.fetchone()
-    
-    if existing_user:
-        conn.close()
-        return False  # User already exists
-
-    # Insert new user
-    cursor.execute('INSERT INTO users (email, password) VALUES (?, ?)', (email, password))
-    conn.commit()
-    conn.close()
+    password_hash = passwords.hasher.hash(password)
+    with db.connection() as conn:
+        # The UNIQUE email constraint does the existence check in the same statement
+        cursor = conn.execute(
+            'INSERT INTO users (email, password) VALUES (?, ?) ON CONFLICT (email) DO NOTHING',
+            (email, password_hash),
+        )
+        if cursor.rowcount == 0:
+            return False  # User already exists
+    user_cache.invalidate(email)  # Drop a cached "no such user"
     return True  # User inserted successfully
 
+def find_user(email):
+    # (id, password hash) for the email, or None. Only an unknown email is answered from
+    # the cache, the hash is always read so another worker's password change applies at once.
+    try:
+        return user_cache.get(email, unknown_only=True)  # Always None
+    except KeyError:
+        pass
+    with db.connection() as conn:
+        row = conn.execute('SELECT id, password FROM users WHERE email = ?', (email,)).fetchone()
+    user_cache.set(email, row[0] if row else None)
+    return tuple(row) if row else None
+
+def find_user_id(email):
+    # The id for the email, or None; served from the cache when possible
+    try:
+        return user_cache.get(email)
+    except KeyError:
+        pass
+    with db.connection() as conn:
+        row = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+    user_id = row[0] if row else None
+    user_cache.set(email, user_id)
+    return user_id
+
+def email_for(user_id):
+    with db.connection() as conn:
+        row = conn.execute('SELECT email FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
 def get_user(email, password):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE email = ? AND password = ?', (email, password))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    user = find_user(email)
+    if not user:
+        return None
+
+    user_id, stored = user
+    matches, new_hash = passwords.hasher.check(password, stored)
+    if not matches:
+        return None
+    if new_hash:
+        update_password_hash(user_id, stored, new_hash)
+    return (user_id, email, stored)
+
+def update_password_hash(user_id, old_password, new_hash):
+    # Only replaces the value we checked against, so a concurrent password change wins
+    with db.connection() as conn:
+        conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?', (new_hash, user_id, old_password))
 
-# Create the table
-create_table()
+def change_password(email, new_password):
+    password_hash = passwords.hasher.hash(new_password)
+    with db.connection() as conn:
+        changed = conn.execute('UPDATE users SET password = ? WHERE email = ?', (password_hash, email)).rowcount
+    return changed == 1
 
 # import sqlite3
 
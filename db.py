@@ -0,0 +1,224 @@
+import sqlite3
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import migrations
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.environ.get('DB_PATH', 'users.db')
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))  # Max open connections per worker process
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5.0))  # Seconds to wait for a free connection
+STATEMENT_CACHE_SIZE = 128  # Prepared statements kept per connection
+BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 5.0))  # Seconds to wait on a locked database
+
+# Applied once to every new connection
+PRAGMAS = (
+    ('journal_mode', 'WAL'),  # Readers no longer block behind a writer
+    ('synchronous', 'NORMAL'),  # Safe with WAL, avoids an fsync per commit
+    ('cache_size', -16000),  # Negative value means KiB, i.e. ~16 MB page cache
+    ('mmap_size', 268435456),  # Map up to 256 MB of the database file
+    ('temp_store', 'MEMORY'),
+)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def _gevent_patched():
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('time')
+
+
+class CooperativeConnection(sqlite3.Connection):
+    # SQLite's own busy handler sleeps inside C, which under gevent stalls every greenlet
+    # of the worker while another process holds the write lock. These connections fail
+    # fast instead and wait between attempts with time.sleep, which gevent patches to
+    # yield. A statement that got SQLITE_BUSY did nothing, so running it again is safe.
+
+    def _retry(self, method, *args):
+        deadline = None
+        delay = 0.001
+        while True:
+            try:
+                return method(self, *args)
+            except sqlite3.OperationalError as e:
+                if not str(e).startswith('database is locked'):
+                    raise
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + BUSY_TIMEOUT
+                if now >= deadline:
+                    raise
+                time.sleep(min(delay, deadline - now))
+                delay = min(delay * 2, 0.05)
+
+    def execute(self, sql, parameters=()):
+        return self._retry(sqlite3.Connection.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._retry(sqlite3.Connection.executemany, sql, parameters)
+
+    def commit(self):
+        return self._retry(sqlite3.Connection.commit)
+
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections must never cross a fork, so every worker builds its own pool
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()  # LIFO keeps the warmest connection in use
+        self._created = 0
+        self._acquires = 0
+        self._hits = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+
+    def _connect(self):
+        cooperative = _gevent_patched()
+        conn = sqlite3.connect(
+            self.path,
+            timeout=0 if cooperative else BUSY_TIMEOUT,
+            check_same_thread=False,  # Connections move between request threads via the pool
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=CooperativeConnection if cooperative else sqlite3.Connection,
+        )
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def acquire(self):
+        self._check_pid()
+        with self._lock:
+            self._acquires += 1
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Pool exhausted, wait for another thread to hand a connection back
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._waits += 1
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
+        return conn
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return  # Connection belongs to the parent process, drop it
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            acquires = self._acquires
+            return {
+                'size': self.size,
+                'open': self._created,
+                'idle': self._idle.qsize(),
+                'acquires': acquires,
+                'hits': self._hits,
+                'hit_rate': self._hits / acquires if acquires else 0.0,
+                'waits': self._waits,
+                'avg_wait_ms': self._wait_time / self._waits * 1000 if self._waits else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+                'timeouts': self._timeouts,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Nothing touches the database before the first query, and that query
+                # finds the schema current (gunicorn and the release step migrate first)
+                migrations.migrate(DB_PATH)
+                _pool = ConnectionPool(DB_PATH)
+                logger.info("Opened SQLite pool for %s (size %d)", DB_PATH, _pool.size)
+    return _pool
+
+
+def connection():
+    # Usage: with db.connection() as conn: ...
+    # Commits on success, rolls back on error and returns the connection to the pool
+    return get_pool().connection()
+
+
+def pool_stats():
+    return get_pool().stats()
@@ -0,0 +1,183 @@
+# Registry of ESP32 door controllers, kept in users.db.
+#
+# Lookups are served from an in-memory snapshot of the tables that is reloaded every
+# CACHE_TTL seconds, so /api/sendPin never queries SQLite on the hot path.
+#
+#   python devices.py add front-door http://192.168.1.100/receivePin --email a@example.com
+#   python devices.py add back-door pull --email a@example.com   (prints the device's token)
+#   python devices.py list
+import argparse
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import time
+from collections import namedtuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEVICE = 'default'  # Id used for ESP32_URL when a user has no device of their own
+PULL = 'pull'  # Address of a device that fetches its PINs instead of receiving them
+
+Device = namedtuple('Device', 'id address healthy last_error checked_at token_hash')
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class DeviceRegistry:
+    CACHE_TTL = 30.0  # Seconds before the snapshot is reloaded, i.e. how long other workers' edits take to show
+
+    def __init__(self, default_address=None, cache_ttl=CACHE_TTL):
+        self.default_address = default_address
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._owners = {}  # email -> tuple of device ids
+        self._loaded_at = None
+        self._loads = 0
+        self._hits = 0
+
+    def _snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.cache_ttl:
+                self._hits += 1
+                return self._devices, self._owners
+        with db.connection() as conn:
+            rows = conn.execute('SELECT id, address, healthy, last_error, checked_at, token_hash FROM devices').fetchall()
+            owner_rows = conn.execute('SELECT email, device_id FROM device_owners ORDER BY device_id').fetchall()
+        devices = {row[0]: Device(row[0], row[1], bool(row[2]), row[3], row[4], row[5]) for row in rows}
+        owners = {}
+        for email, device_id in owner_rows:
+            if device_id in devices:
+                owners.setdefault(email, []).append(device_id)
+        owners = {email: tuple(ids) for email, ids in owners.items()}
+        with self._lock:
+            self._devices, self._owners = devices, owners
+            self._loaded_at = now
+            self._loads += 1
+        return devices, owners
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def get(self, device_id):
+        devices, _ = self._snapshot()
+        device = devices.get(device_id)
+        if device is None and device_id == DEFAULT_DEVICE and self.default_address:
+            device = Device(DEFAULT_DEVICE, self.default_address, True, None, None, None)
+        return device
+
+    def resolve(self, email, device_id=None):
+        # Devices a PIN for email goes to: the one asked for, else every device the
+        # user owns, else the default device. A device the user doesn't own is refused.
+        devices, owners = self._snapshot()
+        owned = owners.get(email, ())
+        if device_id is not None:
+            if device_id in owned or (device_id == DEFAULT_DEVICE and not owned):
+                device = self.get(device_id)
+                return [device] if device else []
+            return []
+        if owned:
+            return [devices[i] for i in owned]
+        device = self.get(DEFAULT_DEVICE)
+        return [device] if device else []
+
+    def authenticate(self, device_id, token):
+        # Returns the pull device the token belongs to, or None
+        device = self.get(device_id)
+        if device is None or not device.token_hash or not token:
+            return None
+        return device if hmac.compare_digest(device.token_hash, hash_token(token)) else None
+
+    def all(self):
+        devices, _ = self._snapshot()
+        return list(devices.values())
+
+    def register(self, device_id, address, emails=()):
+        # Returns the token a pull device authenticates with; it is only stored hashed
+        token = secrets.token_urlsafe(32) if address == PULL else None
+        with db.connection() as conn:
+            conn.execute(
+                'INSERT INTO devices (id, address, token_hash) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET address = excluded.address, token_hash = excluded.token_hash',
+                (device_id, address, token and hash_token(token)),
+            )
+            conn.executemany(
+                'INSERT INTO device_owners (email, device_id) VALUES (?, ?) ON CONFLICT DO NOTHING',
+                [(email, device_id) for email in emails],
+            )
+        self.invalidate()
+        return token
+
+    def remove(self, device_id):
+        with db.connection() as conn:
+            conn.execute('DELETE FROM device_owners WHERE device_id = ?', (device_id,))
+            deleted = conn.execute('DELETE FROM devices WHERE id = ?', (device_id,)).rowcount
+        self.invalidate()
+        return deleted > 0
+
+    def record_health(self, device_id, healthy, error=None):
+        # Called by the dispatcher when a device goes up or down, not on every delivery.
+        # The default device has no row, its health only lives in the dispatcher.
+        error = None if healthy else error
+        now = time.time()
+        with db.connection() as conn:
+            conn.execute(
+                'UPDATE devices SET healthy = ?, last_error = ?, checked_at = ? WHERE id = ?',
+                (int(healthy), error, now, device_id),
+            )
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                # Copy on write, readers hold on to the snapshot they got without locking
+                self._devices = dict(self._devices)
+                self._devices[device_id] = device._replace(healthy=healthy, last_error=error, checked_at=now)
+
+    def stats(self):
+        devices, owners = self._snapshot()
+        with self._lock:
+            return {
+                'devices': len(devices),
+                'unhealthy': sum(1 for d in devices.values() if not d.healthy),
+                'owners': len(owners),
+                'cache_loads': self._loads,
+                'cache_hits': self._hits,
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage ESP32 devices')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='Register a device or change its address')
+    add.add_argument('id')
+    add.add_argument('address', help="PIN endpoint, e.g. http://192.168.1.100/receivePin, or 'pull'")
+    add.add_argument('--email', action='append', default=[], help='User allowed to open it, repeatable')
+    remove = commands.add_parser('remove', help='Delete a device')
+    remove.add_argument('id')
+    commands.add_parser('list', help='Show devices and their health')
+    args = parser.parse_args()
+
+    registry = DeviceRegistry()
+    if args.command == 'add':
+        token = registry.register(args.id, args.address, args.email)
+        print(f"Registered {args.id} at {args.address}")
+        if token:
+            print(f"Device token (shown once): {token}")
+    elif args.command == 'remove':
+        print(f"Removed {args.id}" if registry.remove(args.id) else f"No device {args.id}")
+    else:
+        _, owners = registry._snapshot()
+        by_device = {}
+        for email, ids in owners.items():
+            for device_id in ids:
+                by_device.setdefault(device_id, []).append(email)
+        for device in registry.all():
+            health = 'up' if device.healthy else f'down ({device.last_error})'
+            print(f"{device.id:<20} {device.address:<40} {health:<10} {', '.join(by_device.get(device.id, []))}")
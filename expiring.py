@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class ExpiringStore:
+    # Dict-like store where every key lives for a fixed TTL.
+    # Because the TTL is the same for every key, insertion order is expiry order:
+    # the OrderedDict front is always the next key to expire, so a sweep only ever
+    # pops from the front and each key is touched once (O(1) amortized).
+    # When max_size is reached the soonest-to-expire key is evicted.
+
+    def __init__(self, ttl, max_size=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.expirations = 0
+        self.evictions = 0
+
+    def _sweep(self, now):
+        data = self._data
+        while data:
+            key, (expires_at, _) = next(iter(data.items()))
+            if expires_at > now:
+                break
+            del data[key]
+            self.expirations += 1
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            now = self._clock()
+            self._sweep(now)
+            data = self._data
+            if key in data:
+                del data[key]  # Re-inserting moves the key to the back with a fresh TTL
+            elif len(data) >= self.max_size:
+                data.popitem(last=False)
+                self.evictions += 1
+            data[key] = (now + self.ttl, value)
+
+    def add(self, key, value):
+        # Set the key only if it is absent (or expired); returns whether it was set
+        with self._lock:
+            now = self._clock()
+            self._sweep(now)
+            data = self._data
+            if key in data:
+                return False
+            if len(data) >= self.max_size:
+                data.popitem(last=False)
+                self.evictions += 1
+            data[key] = (now + self.ttl, value)
+            return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= self._clock():
+                del self._data[key]
+                self.expirations += 1
+                return default
+            return entry[1]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            if entry[0] <= self._clock():
+                self.expirations += 1
+                return default
+            return entry[1]
+
+    def pop_if_equal(self, key, expected):
+        # Atomically remove the key only if it still holds the expected value
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] != expected:
+                return False
+            del self._data[key]
+            if entry[0] <= self._clock():
+                self.expirations += 1
+                return False
+            return True
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def keys(self):
+        # Snapshot of the live keys, soonest to expire first
+        with self._lock:
+            self._sweep(self._clock())
+            return list(self._data)
+
+    def sweep(self):
+        with self._lock:
+            self._sweep(self._clock())
+
+    def __len__(self):
+        with self._lock:
+            self._sweep(self._clock())
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            self._sweep(self._clock())
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,208 @@
+# Fingerprint templates for /api/verifyFingerprint.
+#
+# The scanner app turns a fingerprint into a fixed-length feature vector. Enrolled vectors
+# are L2-normalised and kept as float32 rows of a memory-mapped .npy file (1 KiB per user
+# at 256 dimensions, shared by all workers through the page cache), so matching is a dot
+# product: one row for 1:1 verification, blocks of rows for 1:N identification. float32
+# rather than float16 because numpy has no fast half-precision matrix product, and
+# converting every block would cost several times the product itself.
+# The fingerprint_templates table maps users to rows; other workers see new enrolments
+# after reload_interval seconds.
+import base64
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import db
+
+logger = logging.getLogger(__name__)
+
+DIM = int(os.environ.get('FINGERPRINT_DIM', 256))
+DTYPE = np.float32
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def parse_template(value, dim=DIM):
+    # Accepts a JSON list of numbers or base64 of little-endian float32s; returns a unit vector
+    if isinstance(value, str):
+        try:
+            vector = np.frombuffer(base64.b64decode(value, validate=True), dtype='<f4')
+        except ValueError:
+            raise TemplateError("Template is not valid base64 float32 data")
+    elif isinstance(value, list):
+        try:
+            vector = np.asarray(value, dtype=np.float32)
+        except (TypeError, ValueError):
+            raise TemplateError("Template must be a list of numbers")
+    else:
+        raise TemplateError("Template is required")
+    if vector.shape != (dim,):
+        raise TemplateError(f"Template must have {dim} values")
+    norm = float(np.linalg.norm(vector))
+    if not np.isfinite(norm) or norm == 0:
+        raise TemplateError("Template is empty")
+    return (vector / norm).astype(np.float32)
+
+
+class FingerprintStore:
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, path, dim=DIM, batch_size=16384, reload_interval=5.0):
+        self.path = path
+        self.dim = dim
+        self.batch_size = batch_size  # Rows scored per block in identify(), bounds the scratch memory for scores
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._matrix = None
+        self._slots = {}  # user id -> row
+        self._user_ids = np.empty(0, dtype=np.int64)  # row -> user id, -1 for a free row
+        self._rows = 0  # Rows up to the last one in use, identify() skips the rest
+        self._loaded_at = None
+        self._verifications = 0
+        self._identifications = 0
+        self._rows_scanned = 0
+
+    def _open(self, capacity):
+        # Created on first enrolment; grown by copying into a larger file that replaces it
+        if os.path.exists(self.path):
+            matrix = np.load(self.path, mmap_mode='r+')
+            if matrix.shape[1] != self.dim:
+                raise TemplateError(f"{self.path} holds {matrix.shape[1]}-value templates, not {self.dim}")
+            if matrix.shape[0] >= capacity:
+                return matrix
+            grown = np.lib.format.open_memmap(self.path + '.tmp', mode='w+', dtype=DTYPE,
+                                              shape=(max(capacity, matrix.shape[0] * 2), self.dim))
+            grown[:matrix.shape[0]] = matrix
+            grown.flush()
+            del grown
+            os.replace(self.path + '.tmp', self.path)
+            return np.load(self.path, mmap_mode='r+')
+        matrix = np.lib.format.open_memmap(self.path, mode='w+', dtype=DTYPE,
+                                           shape=(max(capacity, self.INITIAL_CAPACITY), self.dim))
+        matrix.flush()
+        return matrix
+
+    def _load(self):
+        with db.connection() as conn:
+            rows = conn.execute('SELECT user_id, slot FROM fingerprint_templates').fetchall()
+        slots = dict(rows)
+        matrix = None
+        if os.path.exists(self.path):
+            matrix = np.load(self.path, mmap_mode='r+')
+        user_ids = np.full(matrix.shape[0] if matrix is not None else 0, -1, dtype=np.int64)
+        if rows:
+            pairs = np.array(rows, dtype=np.int64)
+            pairs = pairs[pairs[:, 1] < len(user_ids)]  # A row of a file grown by another worker, not reopened yet
+            user_ids[pairs[:, 1]] = pairs[:, 0]
+        self._matrix, self._slots, self._user_ids = matrix, slots, user_ids
+        self._rows = int(np.max(np.nonzero(user_ids >= 0)[0], initial=-1)) + 1
+        self._loaded_at = time.monotonic()
+        self._pid = os.getpid()
+
+    def _current(self):
+        # Memory maps are reopened in every worker and refreshed for other workers' enrolments
+        with self._lock:
+            if (self._pid != os.getpid() or self._loaded_at is None
+                    or time.monotonic() - self._loaded_at >= self.reload_interval):
+                self._load()
+            return self._matrix, self._slots, self._user_ids, self._rows
+
+    def enroll_many(self, templates):
+        # templates: iterable of (user_id, unit vector). Replaces existing enrolments.
+        templates = list(templates)
+        with self._lock:
+            with db.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')  # One enrolment at a time across workers, slots stay unique
+                slots = dict(conn.execute('SELECT user_id, slot FROM fingerprint_templates').fetchall())
+                next_slot = max(slots.values(), default=-1) + 1
+                for user_id, _ in templates:
+                    if user_id not in slots:
+                        slots[user_id] = next_slot
+                        next_slot += 1
+                matrix = self._open(next_slot)
+                for user_id, vector in templates:
+                    matrix[slots[user_id]] = vector
+                matrix.flush()  # Rows must be on disk before another worker can find them by slot
+                now = time.time()
+                conn.executemany(
+                    'INSERT INTO fingerprint_templates (user_id, slot, enrolled_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT (user_id) DO UPDATE SET enrolled_at = excluded.enrolled_at',
+                    [(user_id, slots[user_id], now) for user_id, _ in templates],
+                )
+            self._load()
+
+    def enroll(self, user_id, vector):
+        self.enroll_many([(user_id, vector)])
+
+    def remove(self, user_id):
+        with self._lock:
+            self._load()
+            slot = self._slots.get(user_id)
+            if slot is None:
+                return False
+            with db.connection() as conn:
+                conn.execute('DELETE FROM fingerprint_templates WHERE user_id = ?', (user_id,))
+            self._matrix[slot] = 0  # A zero row scores 0 against everything
+            self._matrix.flush()
+            self._load()
+            return True
+
+    def verify(self, user_id, vector):
+        # 1:1, cosine similarity with the user's template, or None when not enrolled
+        matrix, slots, _, _ = self._current()
+        slot = slots.get(user_id)
+        with self._lock:
+            self._verifications += 1
+        if slot is None or matrix is None:
+            return None
+        return float(np.dot(matrix[slot], vector))
+
+    def identify(self, vector, top_k=1):
+        # 1:N, the top_k enrolled users by cosine similarity as [(user_id, score)]
+        return self.identify_many([vector], top_k)[0]
+
+    def identify_many(self, vectors, top_k=1):
+        # 1:N for several probes at once: each block of templates is scored against all
+        # probes in one matrix product, and only the block's top_k survive per probe
+        matrix, _, user_ids, rows = self._current()
+        probes = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            self._identifications += len(probes)
+        if matrix is None or not rows:
+            return [[] for _ in probes]
+        best_ids = np.empty((0, len(probes)), dtype=np.int64)
+        best_scores = np.empty((0, len(probes)), dtype=np.float32)
+        for start in range(0, rows, self.batch_size):
+            end = min(start + self.batch_size, rows)
+            scores = matrix[start:end] @ probes.T
+            scores[user_ids[start:end] < 0] = -np.inf
+            k = min(top_k, end - start)
+            top = np.argpartition(scores, -k, axis=0)[-k:]
+            best_ids = np.concatenate((best_ids, user_ids[start:end][top]))
+            best_scores = np.concatenate((best_scores, np.take_along_axis(scores, top, axis=0)))
+        with self._lock:
+            self._rows_scanned += rows * len(probes)
+        order = np.argsort(-best_scores, axis=0)[:top_k]
+        return [
+            [(int(best_ids[i, q]), float(best_scores[i, q])) for i in order[:, q] if np.isfinite(best_scores[i, q])]
+            for q in range(len(probes))
+        ]
+
+    def stats(self):
+        _, slots, user_ids, _ = self._current()
+        with self._lock:
+            return {
+                'enrolled': len(slots),
+                'capacity': len(user_ids),
+                'dim': self.dim,
+                'verifications': self._verifications,
+                'identifications': self._identifications,
+                'rows_scanned': self._rows_scanned,
+            }
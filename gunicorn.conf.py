@@ -0,0 +1,89 @@
+# Production server settings, used by the Procfile:
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# SERVER_MODE picks how requests wait on SMTP, the ESP32 and bcrypt:
+#   sync    one request per process
+#   gthread a thread pool per process (default)
+#   async   gevent workers: socket waits yield, so one process holds thousands
+#           of pending auth flows. SQLite calls still block the event loop while
+#           they run; only waits on a locked database yield (db.CooperativeConnection)
+import multiprocessing
+import os
+
+cores = multiprocessing.cpu_count()
+mode = os.environ.get('SERVER_MODE', 'gthread')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 10
+keepalive = 5
+
+if mode == 'async':
+    worker_class = 'gevent'
+    # One event loop per core is enough; concurrency comes from worker_connections
+    workers = int(os.environ.get('WEB_CONCURRENCY', cores))
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 2000))
+    os.environ.setdefault('ADMISSION_CAPACITY', str(worker_connections))
+elif mode == 'gthread':
+    worker_class = 'gthread'
+    workers = int(os.environ.get('WEB_CONCURRENCY', cores))
+    threads = int(os.environ.get('GUNICORN_THREADS', 16))
+    os.environ.setdefault('ADMISSION_CAPACITY', str(threads))
+elif mode == 'sync':
+    worker_class = 'sync'
+    workers = int(os.environ.get('WEB_CONCURRENCY', cores * 2 + 1))
+    # One request at a time: nothing to queue or reserve, only downstream shedding applies
+    os.environ.setdefault('ADMISSION_CAPACITY', '1')
+    os.environ.setdefault('ADMISSION_RESERVED', '0')
+else:
+    raise ValueError(f"Unknown SERVER_MODE: {mode}")
+
+# OTPs, PINs and rate limits must be visible to every worker
+if workers > 1:
+    os.environ.setdefault('STATE_BACKEND', 'sqlite')
+    os.environ.setdefault('METRICS_DIR', '/tmp/esss-metrics')
+
+
+# Import the app once in the master and fork the workers from it, so a worker boots
+# without re-importing Flask, numpy and requests. Safe because importing app.py opens no
+# database, threads or sockets. Not under gevent, which must patch before the import.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0' if mode == 'async' else '1') == '1'
+
+
+def on_starting(server):
+    # Schema migrations run once per deploy, before any worker serves. Only the
+    # migrations module is imported here, so the master stays free of app state.
+    import metrics
+    import migrations
+    metrics.clear()  # Totals start from zero with every master
+    db_path = os.environ.get('DB_PATH', 'users.db')  # db.DB_PATH
+    before = migrations.migrate(db_path)
+    if before < migrations.LATEST:
+        server.log.info(f"Migrated {db_path} from schema version {before} to {migrations.LATEST}")
+    server.log.info(f"SERVER_MODE={mode}: {workers} x {worker_class} worker(s), "
+                    f"state backend {os.environ.get('STATE_BACKEND', 'memory')}, preload {preload_app}")
+
+
+def post_worker_init(worker):
+    # Resume PIN deliveries left pending by the previous run without waiting for traffic
+    from app import pin_outbox
+    pin_outbox.start()
+
+
+def worker_exit(server, worker):
+    # The flusher writes every few seconds, write the counts of the last requests too
+    import metrics
+    if metrics.METRICS_DIR:
+        try:
+            metrics.flush()
+        except OSError as e:
+            server.log.warning(f"Could not write metrics of worker {worker.pid}: {e}")
+
+
+def child_exit(server, worker):
+    # In the master: keep the exited worker's counters, drop its file
+    import metrics
+    try:
+        metrics.archive(worker.pid)
+    except OSError as e:
+        server.log.warning(f"Could not archive metrics of worker {worker.pid}: {e}")
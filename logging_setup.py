@@ -0,0 +1,187 @@
+# Non-blocking logging.
+#
+# Request threads only put the LogRecord on a bounded queue; a listener thread does
+# the formatting (lazily, from msg and args), redaction and the write to stderr.
+# When the queue is full records are dropped and counted instead of blocking.
+# The listener is started by the first record of each process, so configuring logging
+# at import starts no thread and every forked worker gets its own.
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+
+REDACTED = '***'
+SECRET_FIELDS = frozenset(('otp', 'pin', 'password', 'token', 'secret'))
+# Safety net for secrets that end up in message text: "OTP 123456", "pin: 1234", "password=hunter2"
+_CODE_IN_TEXT = re.compile(r'\b(otp|pin|code)\b(\W{1,3})(\d{3,10})\b', re.IGNORECASE)
+_SECRET_IN_TEXT = re.compile(r'\b(password|token|secret)\b(\s*[:=]\s*)([^\s,;]+)', re.IGNORECASE)
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if str(k).lower() in SECRET_FIELDS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(redact(v) for v in value)
+    if isinstance(value, str):
+        value = _CODE_IN_TEXT.sub(_mask, value)
+        return _SECRET_IN_TEXT.sub(_mask, value)
+    return value
+
+
+def _mask(match):
+    return f'{match.group(1)}{match.group(2)}{REDACTED}'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        args = record.args
+        if isinstance(args, dict):
+            args = redact(args)
+        elif args:
+            args = tuple(redact(a) if isinstance(a, (dict, list, tuple)) else a for a in args)
+        message = record.msg % args if args else str(record.msg)
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact(message),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = REDACTED if key.lower() in SECRET_FIELDS else redact(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RedactingTextFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a fraction of the records below WARNING for the configured loggers,
+    # e.g. {'pin_dispatch': 0.1} keeps one in ten of its info/debug records
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue never leaves the process, so formatting can wait for the listener
+        return record
+
+    def enqueue(self, record):
+        if _listener_pid != os.getpid():
+            _ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+_listener_pid = None
+_max_queue = 10000
+_output = None
+_lock = threading.Lock()
+
+
+def _start_listener():
+    global _listener, _listener_pid
+    log_queue = queue.Queue(maxsize=_max_queue)
+    _handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, _output, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+
+def _ensure_listener():
+    # The listener thread does not survive a fork, so a pid other than the one it was
+    # started in means this process has none yet
+    with _lock:
+        if _listener_pid != os.getpid() and _handler is not None:
+            _start_listener()
+
+
+def _stop_listener():
+    global _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()  # Writes out whatever is still queued
+    _listener_pid = None
+
+
+def parse_sampling(spec):
+    # 'pin_dispatch=0.1,mailer=0.5' -> {'pin_dispatch': 0.1, 'mailer': 0.5}
+    rates = {}
+    for part in filter(None, (p.strip() for p in (spec or '').split(','))):
+        name, _, rate = part.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def configure_logging(level='INFO', fmt='json', sampling=None, max_queue=10000, stream=None):
+    global _handler, _output, _max_queue
+    with _lock:
+        root = logging.getLogger()
+        if _handler is not None:
+            root.removeHandler(_handler)
+            _stop_listener()
+
+        _output = logging.StreamHandler(stream or sys.stderr)
+        if fmt == 'json':
+            _output.setFormatter(JsonFormatter())
+        else:
+            _output.setFormatter(RedactingTextFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+        _max_queue = max_queue
+        _handler = _NonBlockingQueueHandler(queue.Queue(maxsize=max_queue))
+        if sampling:
+            _handler.addFilter(SamplingFilter(sampling))
+
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(_handler)
+        root.setLevel(level)
+
+
+def dropped_records():
+    return _handler.dropped if _handler is not None else 0
+
+
+def flush():
+    # Blocks until everything queued so far has been written; the next record starts
+    # a new listener
+    with _lock:
+        _stop_listener()
+
+
+def _reset_lock():
+    # Another thread may have held the lock at the fork, the child must not inherit it
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+atexit.register(flush)
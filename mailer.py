@@ -0,0 +1,214 @@
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Outgoing:
+    __slots__ = ('message', 'enqueued_at', 'attempts')
+
+    def __init__(self, message):
+        self.message = message
+        self.enqueued_at = time.perf_counter()
+        self.attempts = 0
+
+
+def is_transient(exc):
+    # 4xx replies and dropped sockets are worth retrying, 5xx replies are not
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return isinstance(exc, OSError)
+
+
+class MailDispatcher:
+    # Sends Flask-Mail messages from a small pool of background threads.
+    # Each thread keeps one authenticated SMTP connection open between batches,
+    # so request handlers only pay for a queue put.
+
+    def __init__(self, app, mail, workers=2, batch_size=20, max_retries=3,
+                 backoff=0.5, idle_timeout=30.0, send_timeout=30.0, max_queue=10000):
+        self.app = app
+        self.mail = mail
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout  # Close an unused SMTP connection after this many seconds
+        self.send_timeout = send_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._enqueued = 0
+        self._dropped = 0
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._connections = 0
+        self._batches = 0
+        self._send_time = 0.0
+        self._max_send = 0.0
+        self._queue_time = 0.0
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start them lazily inside each worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'mail-dispatch-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def submit(self, message):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(_Outgoing(message))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            logger.error("Mail queue full, dropping message to %s", message.recipients)
+            return False
+        with self._lock:
+            self._enqueued += 1
+        return True
+
+    def queue_delay(self):
+        # Seconds the oldest queued message has waited, 0 when nothing is waiting. Peeks at
+        # the underlying deque without the queue's lock, which gevent's Queue does not have.
+        try:
+            oldest = self._queue.queue[0]
+        except IndexError:
+            return 0.0
+        if oldest is _STOP:
+            return 0.0
+        return time.perf_counter() - oldest.enqueued_at
+
+    def stop(self, timeout=5.0):
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def _open(self):
+        conn = self.mail.connect()
+        conn.__enter__()
+        if conn.host is not None and conn.host.sock is not None:
+            conn.host.sock.settimeout(self.send_timeout)
+        with self._lock:
+            self._connections += 1
+        return conn
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass  # The server may already have dropped us
+        return None
+
+    def _run(self):
+        with self.app.app_context():
+            conn = None
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    conn = self._close(conn)
+                    continue
+
+                batch = [item]
+                while item is not _STOP and len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)  # Each thread takes at most one stop marker
+
+                stopping = False
+                for item in batch:
+                    if item is _STOP:
+                        stopping = True
+                    else:
+                        conn = self._deliver(conn, item)
+                with self._lock:
+                    self._batches += 1
+
+                if stopping:
+                    self._close(conn)
+                    return
+
+    def _deliver(self, conn, item):
+        while True:
+            item.attempts += 1
+            try:
+                if conn is None:
+                    conn = self._open()
+                start = time.perf_counter()
+                conn.send(item.message)
+                end = time.perf_counter()
+            except Exception as e:
+                if is_transient(e) and item.attempts <= self.max_retries:
+                    conn = self._close(conn)
+                    delay = self.backoff * 2 ** (item.attempts - 1)
+                    logger.warning("Transient mail error (%s), retrying in %.1fs", e, delay)
+                    with self._lock:
+                        self._retries += 1
+                    time.sleep(delay)
+                    continue
+                if is_transient(e):
+                    conn = self._close(conn)
+                with self._lock:
+                    self._failed += 1
+                metrics.inc('errors_total', stage='mail')
+                logger.error("Failed to send mail to %s: %s", item.message.recipients, e)
+                return conn
+
+            send_time = end - start
+            metrics.observe('mail_send_duration_seconds', send_time)
+            metrics.observe('mail_queue_wait_seconds', start - item.enqueued_at)
+            with self._lock:
+                self._sent += 1
+                self._send_time += send_time
+                self._max_send = max(self._max_send, send_time)
+                self._queue_time += start - item.enqueued_at
+            logger.info("Mail sent successfully to %s", item.message.recipients)
+            return conn
+
+    def stats(self):
+        with self._lock:
+            sent = self._sent
+            return {
+                'queue_depth': self._queue.qsize(),
+                'workers': len(self._threads),
+                'enqueued': self._enqueued,
+                'dropped': self._dropped,
+                'sent': sent,
+                'failed': self._failed,
+                'retries': self._retries,
+                'batches': self._batches,
+                'connections_opened': self._connections,
+                'avg_send_ms': self._send_time / sent * 1000 if sent else 0.0,
+                'max_send_ms': self._max_send * 1000,
+                'avg_queue_ms': self._queue_time / sent * 1000 if sent else 0.0,
+            }
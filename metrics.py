@@ -0,0 +1,302 @@
+# In-process metrics rendered in the Prometheus text format.
+#
+# Every OS thread records into its own shard, so the hot path is a plain dict update
+# with no lock; shards are only summed when /metrics is scraped. Under gevent all the
+# greenlets of a thread share its shard: they only switch on I/O, never inside an
+# update. With METRICS_DIR set, each gunicorn worker also writes its totals there and a
+# scrape on any worker merges the files of all workers; the master folds the file of an
+# exited worker into an archive file (see gunicorn.conf.py).
+import _thread
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _original_get_ident():
+    # gevent patches _thread.get_ident to name the current greenlet, which would give
+    # every request its own shard and keep them all
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        return monkey.get_original('_thread', 'get_ident')
+    return _thread.get_ident
+
+
+_get_ident = _original_get_ident()
+
+
+class _Shard:
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+
+class Registry:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._descriptions = {}  # name -> (type, help)
+        self._gauges = {}  # name -> callable returning {labels: value}
+        self._reset()
+
+    def _reset(self):
+        self._shards = {}  # OS thread id -> _Shard
+        self._flusher = None
+
+    def describe(self, name, kind, help_text):
+        self._descriptions[name] = (kind, help_text)
+
+    def gauge(self, name, help_text, fn):
+        # fn() returns a number or a dict of {labels tuple: number}, evaluated at scrape time
+        self.describe(name, 'gauge', help_text)
+        self._gauges[name] = fn
+
+    def _shard(self):
+        ident = _get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            # A thread id reused after its thread exited keeps adding to the same shard
+            shard = _Shard()
+            with self._lock:
+                self._shards[ident] = shard
+                if METRICS_DIR and self._flusher is None:
+                    self._start_flusher()
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histograms = self._shard().histograms
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = [0] * (len(self.buckets) + 2)
+        hist[bisect.bisect_left(self.buckets, value)] += 1
+        hist[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _collect_gauges(self):
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning("Metric gauge %s failed: %s", name, e)
+                continue
+            if not isinstance(value, dict):
+                value = {(): value}
+            for labels, v in value.items():
+                gauges[(name, tuple(labels))] = v
+        return gauges
+
+    def snapshot(self):
+        counters, histograms = {}, {}
+        with self._lock:
+            shards = list(self._shards.values())
+        for shard in shards:
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, hist in list(shard.histograms.items()):
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(hist)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, hist)]
+        return counters, histograms, self._collect_gauges()
+
+    # Multi-process support
+
+    def _path(self, pid):
+        return os.path.join(METRICS_DIR, f'metrics-{pid}.json')
+
+    def flush(self):
+        counters, histograms, gauges = self.snapshot()
+        data = {
+            'counters': [[k[0], k[1], v] for k, v in counters.items()],
+            'histograms': [[k[0], k[1], v] for k, v in histograms.items()],
+            'gauges': [[k[0], k[1], v] for k, v in gauges.items()],
+        }
+        os.makedirs(METRICS_DIR, exist_ok=True)  # A scrape can come before the first flusher run
+        _write(self._path(os.getpid()), data)
+
+    def archive(self, pid):
+        # Run by the gunicorn master when a worker exits. Its counters and histograms are
+        # added to metrics-archive.json and its own file removed, so totals survive worker
+        # restarts while the directory keeps one file per live worker.
+        if not METRICS_DIR:
+            return
+        path = self._path(pid)
+        try:
+            data = _read(path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            data = None
+        if data is not None:
+            counters, histograms = {}, {}
+            try:
+                _fold(_read(self._path('archive')), counters, histograms)
+            except (OSError, ValueError):
+                pass
+            _fold(data, counters, histograms)
+            _write(self._path('archive'), {
+                'counters': [[k[0], k[1], v] for k, v in counters.items()],
+                'histograms': [[k[0], k[1], v] for k, v in histograms.items()],
+                'gauges': [],
+            })
+        os.remove(path)
+
+    def clear(self):
+        # Run by the gunicorn master before it forks any worker: files left by an earlier
+        # run would otherwise be added to this one's totals
+        if not METRICS_DIR:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for filename in os.listdir(METRICS_DIR):
+            if filename.startswith('metrics-'):
+                os.remove(os.path.join(METRICS_DIR, filename))
+
+    def _start_flusher(self):
+        def run():
+            while True:
+                time.sleep(FLUSH_INTERVAL)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.warning("Failed to write metrics: %s", e)
+
+        self._flusher = threading.Thread(target=run, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def _merged(self):
+        if not METRICS_DIR:
+            return self.snapshot()
+        self.flush()
+        counters, histograms, gauges = {}, {}, {}
+        for filename in os.listdir(METRICS_DIR):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            pid = filename[len('metrics-'):-len('.json')]
+            try:
+                data = _read(os.path.join(METRICS_DIR, filename))
+            except (OSError, ValueError):
+                continue
+            # Counters of exited workers still count, their gauges do not
+            _fold(data, counters, histograms)
+            if pid.isdigit() and _alive(int(pid)):
+                for name, labels, value in data['gauges']:
+                    gauges[(name, tuple(map(tuple, labels)) + (('pid', pid),))] = value
+        return counters, histograms, gauges
+
+    def render(self):
+        counters, histograms, gauges = self._merged()
+        lines = []
+        by_name = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append(('counter', labels, value))
+        for (name, labels), value in histograms.items():
+            by_name.setdefault(name, []).append(('histogram', labels, value))
+        for (name, labels), value in gauges.items():
+            by_name.setdefault(name, []).append(('gauge', labels, value))
+
+        for name in sorted(by_name):
+            samples = by_name[name]
+            kind, help_text = self._descriptions.get(name, (samples[0][0], ''))
+            if help_text:
+                lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_kind, labels, value in sorted(samples, key=lambda s: s[1]):
+                if sample_kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _read(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _fold(data, counters, histograms):
+    # Adds the counters and histograms of one metrics file to the totals
+    for name, labels, value in data['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, hist in data['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        total = histograms.get(key)
+        histograms[key] = hist if total is None else [a + b for a, b in zip(total, hist)]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = (f'{k}="{_escape(v)}"' for k, v in labels)
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+# Counts recorded before a fork belong to the parent, each worker starts empty
+os.register_at_fork(after_in_child=registry._reset)
+
+describe = registry.describe
+gauge = registry.gauge
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+render = registry.render
+flush = registry.flush
+archive = registry.archive
+clear = registry.clear
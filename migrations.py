@@ -0,0 +1,163 @@
+# Versioned schema of users.db.
+#
+# Each step runs once, in order, and the version reached is kept in SQLite's
+# PRAGMA user_version. migrate() holds the database write lock (BEGIN IMMEDIATE) while it
+# applies the pending steps, so concurrent callers (workers booting together, a release
+# command racing a dyno restart) apply them exactly once and the others wait and then
+# find nothing to do. All steps of a run commit together or not at all.
+#
+# The early steps use IF NOT EXISTS, so databases created before versioning are adopted
+# as they are. Add new steps at the end; never edit one that has shipped.
+#
+# One exception: the daily audit_events_<YYYYMMDD> partitions are not migrations. audit.py
+# creates each on its first write of the day and drops it once it falls out of retention.
+#
+#   python migrations.py            apply pending steps
+#   python migrations.py --status   show the version of the database
+import argparse
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 60.0  # Seconds to wait for another process's migration to finish
+
+
+def _add_device_tokens(conn):
+    # Tables from before pull devices existed lack the token column
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(devices)')}
+    if 'token_hash' not in columns:
+        conn.execute('ALTER TABLE devices ADD COLUMN token_hash TEXT')
+
+
+MIGRATIONS = (
+    (1, 'users', (
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        )''',
+    )),
+    (2, 'shared OTP/PIN state and rate limit buckets', (
+        '''CREATE TABLE IF NOT EXISTS auth_state (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_auth_state_expires ON auth_state (expires_at)',
+        '''CREATE TABLE IF NOT EXISTS rate_buckets (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_rate_buckets_expires ON rate_buckets (expires_at)',
+    )),
+    (3, 'device registry', (
+        '''CREATE TABLE IF NOT EXISTS devices (
+            id TEXT PRIMARY KEY,
+            address TEXT NOT NULL,
+            healthy INTEGER NOT NULL DEFAULT 1,
+            last_error TEXT,
+            checked_at REAL
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS device_owners (
+            email TEXT NOT NULL,
+            device_id TEXT NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+            PRIMARY KEY (email, device_id)
+        ) WITHOUT ROWID''',
+    )),
+    (4, 'PIN outbox', (
+        '''CREATE TABLE IF NOT EXISTS pin_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL,
+            device_id TEXT NOT NULL,
+            pin TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            delivered_at REAL,
+            last_error TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_pin_outbox_due ON pin_outbox (status, next_attempt_at)',
+    )),
+    (5, 'pull device tokens', _add_device_tokens),
+    (6, 'fingerprint templates', (
+        '''CREATE TABLE IF NOT EXISTS fingerprint_templates (
+            user_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+            slot INTEGER NOT NULL UNIQUE,
+            enrolled_at REAL NOT NULL
+        )''',
+    )),
+)
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def _connect(path):
+    # Autocommit mode, so the BEGIN below is the only transaction
+    return sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+
+
+def version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(path):
+    # Brings the database at path up to LATEST. Returns the version it was at.
+    conn = _connect(path)
+    try:
+        current = version(conn)
+        if current >= LATEST:
+            return current  # The common case: one read, no lock
+        conn.execute('BEGIN IMMEDIATE')
+        current = version(conn)  # Another process may have migrated while we waited
+        for number, description, step in MIGRATIONS:
+            if number <= current:
+                continue
+            logger.info("Applying migration %d: %s", number, description)
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {max(current, LATEST)}')
+        conn.execute('COMMIT')
+        return current
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def status(path):
+    conn = _connect(path)
+    try:
+        return version(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import db
+
+    parser = argparse.ArgumentParser(description='Apply schema migrations to the database')
+    parser.add_argument('--status', action='store_true', help='Only print the schema version')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.status:
+        current = status(db.DB_PATH)
+        print(f"{db.DB_PATH}: version {current} of {LATEST}")
+    else:
+        before = migrate(db.DB_PATH)
+        print(f"{db.DB_PATH}: version {before} -> {max(before, LATEST)}")
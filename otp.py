@@ -0,0 +1,46 @@
+import hashlib
+import hmac
+import time
+
+
+class TotpGenerator:
+    # Derives OTPs from a server secret, the email and a time step (RFC 4226/6238 style),
+    # so a code can be checked by recomputing it instead of looking it up.
+
+    def __init__(self, secret, step=300, window=1, digits=6, clock=time.time):
+        if not secret:
+            raise ValueError("A secret is required for stateless OTPs")
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.step = step  # Seconds each code stays current
+        self.window = window  # Previous steps still accepted, covers mail delay
+        self.digits = digits
+        self._clock = clock
+
+    def counter(self):
+        return int(self._clock() // self.step)
+
+    def derive(self, email, counter):
+        digest = hmac.new(self.secret, f'{email}:{counter}'.encode(), hashlib.sha256).digest()
+        # Dynamic truncation as in HOTP
+        offset = digest[-1] & 0x0F
+        code = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7FFFFFFF
+        return code % 10 ** self.digits
+
+    def generate(self, email):
+        return self.derive(email, self.counter())
+
+    def remaining(self):
+        # Seconds until the current step ends and codes change
+        return self.step - self._clock() % self.step
+
+    def verify(self, email, code):
+        # Returns the matching counter, or None. Callers use the counter to reject replays.
+        current = self.counter()
+        for counter in range(current, current - self.window - 1, -1):
+            if hmac.compare_digest(str(self.derive(email, counter)), str(code)):
+                return counter
+        return None
+
+    def replay_ttl(self):
+        # How long a used counter has to be remembered before it falls out of the window anyway
+        return self.step * (self.window + 1)
@@ -0,0 +1,272 @@
+# Durable PIN outbox.
+#
+# /api/sendPin writes one row per target device in the same transaction as the PIN
+# itself, then tries to deliver straight away. Whatever did not get through stays
+# pending and a background thread in every worker retries it with exponential backoff
+# until it is delivered, the PIN expires or the attempts run out. Each row carries an
+# idempotency key that is sent along, so a device that gets the same PIN twice (a
+# retry racing a slow ack) acts on it once.
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+import db
+from devices import PULL
+from pin_dispatch import DELIVERED as DELIVERY_OK, ACCEPTED
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+WAITING = 'waiting'  # Held for a pull device to fetch
+DELIVERED = 'delivered'
+FAILED = 'failed'  # Gave up after max_attempts, can be retried by hand until the PIN expires
+EXPIRED = 'expired'
+
+SWEEP_INTERVAL = 60.0  # Seconds between expiry and retention passes
+
+
+def delivery_key(email, request_key, device_id):
+    # Client keys are only unique per user: two users retrying with the same key must
+    # still get two deliveries. Hashed so the key has a fixed size and no separators.
+    raw = '\0'.join((email, request_key, device_id)).encode()
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+class PinOutbox:
+    def __init__(self, dispatcher, registry, pin_ttl, max_attempts=10, backoff=1.0, max_backoff=30.0,
+                 batch_size=50, poll_interval=0.5, lease=30.0, retention=86400.0, mailbox=None):
+        self.dispatcher = dispatcher
+        self.registry = registry
+        self.mailbox = mailbox  # Wakes pull devices waiting in this process
+        self.pin_ttl = pin_ttl
+        self.max_attempts = max_attempts
+        self.backoff = backoff  # Seconds before the first retry, doubled per attempt
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease  # Seconds a row in flight is hidden from other workers
+        self.retention = retention  # Seconds finished rows are kept for the admin view
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._results = deque()
+        self._pid = None
+        self._last_sweep = 0.0
+        self._enqueued = 0
+        self._redeliveries = 0
+        self._flushed = 0
+
+    def start(self):
+        # The thread does not survive a fork, so every worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._results = deque()
+            threading.Thread(target=self._run, name='pin-outbox', daemon=True).start()
+            self._pid = os.getpid()
+
+    def enqueue(self, conn, email, pin, devices, request_key=None):
+        # Writes the deliveries inside the caller's transaction. Returns the idempotency
+        # keys of the new rows by device id, plus the status of rows that already existed
+        # for a repeated request_key.
+        self.start()
+        now = time.time()
+        keys = {}
+        existing = {}
+        for device in devices:
+            key = delivery_key(email, request_key, device.id) if request_key else uuid.uuid4().hex
+            inserted = conn.execute(
+                'INSERT INTO pin_outbox (key, email, device_id, pin, status, created_at, expires_at, next_attempt_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO NOTHING',
+                # Leased to this request, which makes the first attempt itself
+                (key, email, device.id, str(pin), WAITING if device.address == PULL else PENDING,
+                 now, now + self.pin_ttl, now + self.lease),
+            ).rowcount
+            if inserted:
+                keys[device.id] = key
+            else:
+                row = conn.execute('SELECT status FROM pin_outbox WHERE key = ?', (key,)).fetchone()
+                existing[device.id] = row[0]
+        with self._lock:
+            self._enqueued += len(keys)
+        return keys, existing
+
+    def _record(self, key, result, error):
+        # Runs on the delivery threads; the worker thread writes results in batches
+        self._results.append((key, result, error, time.time()))
+        self._wake.set()
+
+    def deliver(self, email, pin, devices, keys, wait=0.0):
+        # First attempt, made by the request that enqueued the rows. Pull devices are only
+        # woken up; they count as accepted until they fetch the PIN.
+        pulled = [d for d in devices if d.id in keys and d.address == PULL]
+        for device in pulled:
+            if self.mailbox is not None:
+                self.mailbox.notify(device.id)
+        delivery, results = self.dispatcher.dispatch(
+            email, pin, [d for d in devices if d.id in keys and d.address != PULL], wait=wait, keys=keys,
+            on_done=lambda device_id, result, error: self._record(keys[device_id], result, error),
+        )
+        if pulled:
+            results.update((device.id, ACCEPTED) for device in pulled)
+            if delivery != DELIVERY_OK:
+                delivery = ACCEPTED
+        return delivery, results
+
+    def take(self, device_id):
+        # Hands the PINs waiting for a pull device over, each exactly once
+        now = time.time()
+        with db.connection() as conn:
+            # Cheap unlocked check first, this runs on every long-poll round
+            if conn.execute(
+                "SELECT 1 FROM pin_outbox WHERE device_id = ? AND status = 'waiting' AND expires_at > ? LIMIT 1",
+                (device_id, now),
+            ).fetchone() is None:
+                return []
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                "SELECT id, key, email, pin FROM pin_outbox WHERE device_id = ? AND status = 'waiting' "
+                'AND expires_at > ? ORDER BY id',
+                (device_id, now),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE pin_outbox SET status = 'delivered', delivered_at = ?, pin = NULL, attempts = attempts + 1 "
+                'WHERE id = ?',
+                [(now, row[0]) for row in rows],
+            )
+        return [{'key': key, 'email': email, 'pin': pin} for _, key, email, pin in rows]
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self._flush()
+                self._redeliver()
+                self._maybe_sweep()
+            except Exception:
+                logger.exception("PIN outbox pass failed")
+
+    def _flush(self):
+        results = []
+        while self._results:
+            results.append(self._results.popleft())
+        if not results:
+            return
+        delivered = [(now, key) for key, result, _, now in results if result == DELIVERY_OK]
+        failed = [
+            (error, self.max_attempts, now, now, random.uniform(0.5, 1.0), self.max_backoff, self.backoff, key)
+            for key, result, error, now in results if result != DELIVERY_OK
+        ]
+        with db.connection() as conn:
+            conn.executemany(
+                "UPDATE pin_outbox SET status = 'delivered', delivered_at = ?, pin = NULL, last_error = NULL "
+                "WHERE key = ? AND status = 'pending'",
+                delivered,
+            )
+            # Backoff doubles per attempt with jitter: min(max_backoff, backoff * 2^attempts) * [0.5, 1)
+            conn.executemany(
+                'UPDATE pin_outbox SET attempts = attempts + 1, last_error = ?, '
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' WHEN expires_at <= ? THEN 'expired' "
+                "ELSE 'pending' END, "
+                'next_attempt_at = ? + ? * min(?, ? * (1 << attempts)) '
+                "WHERE key = ? AND status = 'pending'",
+                failed,
+            )
+            conn.execute("UPDATE pin_outbox SET pin = NULL WHERE status = 'expired' AND pin IS NOT NULL")
+        with self._lock:
+            self._flushed += len(results)
+
+    def _claim(self, now):
+        with db.connection() as conn:
+            # Take the write lock first so two workers never claim the same row
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT id, key, email, device_id, pin FROM pin_outbox '
+                "WHERE status = 'pending' AND next_attempt_at <= ? AND expires_at > ? "
+                'ORDER BY next_attempt_at LIMIT ?',
+                (now, now, self.batch_size),
+            ).fetchall()
+            conn.executemany(
+                'UPDATE pin_outbox SET next_attempt_at = ? WHERE id = ?',
+                [(now + self.lease, row[0]) for row in rows],
+            )
+        return rows
+
+    def _redeliver(self):
+        now = time.time()
+        rows = self._claim(now)
+        for _, key, email, device_id, pin in rows:
+            device = self.registry.get(device_id)
+            if device is None:
+                self._results.append((key, 'removed', 'device no longer registered', now))
+                continue
+            self.dispatcher.submit(email, pin, device, key,
+                                   lambda _, result, error, key=key: self._record(key, result, error))
+        if rows:
+            with self._lock:
+                self._redeliveries += len(rows)
+            logger.info("Retrying %d PIN deliveries from the outbox", len(rows))
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        with db.connection() as conn:
+            conn.execute(
+                "UPDATE pin_outbox SET status = 'expired', pin = NULL WHERE status IN ('pending', 'waiting') "
+                'AND expires_at <= ?',
+                (now,),
+            )
+            conn.execute("UPDATE pin_outbox SET pin = NULL WHERE status = 'failed' AND expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM pin_outbox WHERE status IN ('delivered', 'expired', 'failed') AND created_at <= ?",
+                (now - self.retention,),
+            )
+
+    def retry(self, key):
+        # Puts a failed delivery back in the queue; only possible while its PIN is valid
+        with db.connection() as conn:
+            changed = conn.execute(
+                "UPDATE pin_outbox SET status = 'pending', attempts = 0, next_attempt_at = ? "
+                "WHERE key = ? AND status = 'failed' AND expires_at > ? AND pin IS NOT NULL",
+                (time.time(), key, time.time()),
+            ).rowcount
+        self._wake.set()
+        return changed == 1
+
+    def entries(self, status=None, limit=100):
+        query = ('SELECT key, email, device_id, status, attempts, created_at, expires_at, next_attempt_at, '
+                 'delivered_at, last_error FROM pin_outbox')
+        params = ()
+        if status:
+            query += ' WHERE status = ?'
+            params = (status,)
+        query += ' ORDER BY id DESC LIMIT ?'
+        with db.connection() as conn:
+            rows = conn.execute(query, params + (limit,)).fetchall()
+        columns = ('key', 'email', 'device_id', 'status', 'attempts', 'created_at', 'expires_at',
+                   'next_attempt_at', 'delivered_at', 'last_error')
+        return [dict(zip(columns, row)) for row in rows]
+
+    def counts(self):
+        with db.connection() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM pin_outbox GROUP BY status').fetchall())
+
+    def stats(self):
+        counts = self.counts()
+        with self._lock:
+            return {
+                'enqueued': self._enqueued,
+                'redeliveries': self._redeliveries,
+                'results_written': self._flushed,
+                'results_waiting': len(self._results),
+                **counts,
+            }
@@ -0,0 +1,102 @@
+import hmac
+import itertools
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))  # Seconds a login waits for a pool slot plus the check
+
+_BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+def is_hashed(stored):
+    return stored.startswith(_BCRYPT_PREFIXES)
+
+
+def hash_password(password, rounds=BCRYPT_ROUNDS):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def hash_rounds(stored):
+    # '$2b$12$...' -> 12
+    return int(stored.split('$')[2])
+
+
+def check_password(password, stored, rounds=BCRYPT_ROUNDS):
+    # Returns (matches, new_hash). new_hash is set when the stored value is a legacy
+    # plaintext password or was hashed with a different cost and should be replaced.
+    if password is None or stored is None:
+        return False, None
+    if isinstance(stored, bytes):
+        stored = stored.decode()  # Some rows were written as BLOBs
+    if not is_hashed(stored):
+        if hmac.compare_digest(password.encode(), stored.encode()):
+            return True, hash_password(password, rounds)
+        return False, None
+    try:
+        if not bcrypt.checkpw(password.encode(), stored.encode()):
+            return False, None
+    except ValueError:
+        return False, None  # Corrupt hash
+    if hash_rounds(stored) != rounds:
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+def _executor_class():
+    # Under gevent the stdlib pool would run bcrypt on greenlets and stall the event
+    # loop, gevent's own executor runs it on real threads with cooperative futures
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+            return GeventThreadPoolExecutor
+    return ThreadPoolExecutor
+
+
+class PasswordHasher:
+    # Runs bcrypt on a bounded thread pool. bcrypt releases the GIL, so checks use
+    # every core while the pool size caps how much CPU logins can take at once.
+
+    def __init__(self, workers=HASH_WORKERS, rounds=BCRYPT_ROUNDS, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.rounds = rounds
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._dummy = None
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = _executor_class()(max_workers=self.workers, thread_name_prefix='bcrypt')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def check(self, password, stored):
+        return self._pool().submit(check_password, password, stored, self.rounds).result(self.timeout)
+
+    def check_missing(self, password):
+        # For an email with no account: as slow as a failed check, so the response time
+        # does not tell which emails are registered. Always False.
+        if self._dummy is None:
+            self._dummy = self.hash(os.urandom(16).hex())
+        self.check(password, self._dummy)
+        return False
+
+    def hash(self, password):
+        return self._pool().submit(hash_password, password, self.rounds).result(self.timeout)
+
+    def hash_many(self, passwords):
+        # Hashes an iterable of passwords in parallel, preserving order
+        return self._pool().map(hash_password, passwords, itertools.repeat(self.rounds))
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,292 @@
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DELIVERED = 'delivered'
+ACCEPTED = 'accepted'
+FAILED = 'failed'
+QUEUED = 'queued'  # Not delivered yet, left to the outbox to retry
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # closed: calls go through; open: calls fail fast until reset_timeout passes;
+    # half-open: one trial call decides whether to close again
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class _Channel:
+    # One device's connection pool, breaker and counters
+    def __init__(self, address, pool_size, breaker):
+        self.address = address
+        self.breaker = breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.healthy = True
+        self.submitted = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retries = 0
+        self.short_circuited = 0
+        self.delivery_time = 0.0
+
+
+class PinDispatcher:
+    # Delivers PINs to the ESP32 devices from a thread pool, with a keep-alive session
+    # and a circuit breaker per device, so a slow or offline door never holds a request
+    # worker or delays the other doors.
+
+    def __init__(self, registry=None, workers=8, connect_timeout=2.0, read_timeout=5.0,
+                 max_retries=3, backoff=0.25, failure_threshold=5, reset_timeout=30.0):
+        self.registry = registry
+        self.workers = workers
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._channels = {}
+        self._queued = {}  # ticket -> submit time of deliveries no thread has picked up yet, oldest first
+        self._tickets = itertools.count()
+
+    def _ensure_started(self):
+        # Neither threads nor pooled sockets survive a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._channels = {}
+            self._queued = {}
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pin-dispatch')
+            self._pid = os.getpid()
+
+    def _channel(self, device):
+        with self._lock:
+            channel = self._channels.get(device.id)
+            if channel is None or channel.address != device.address:
+                if channel is not None:
+                    channel.session.close()  # The device moved, its pooled sockets are stale
+                channel = _Channel(device.address, self.workers,
+                                   CircuitBreaker(self.failure_threshold, self.reset_timeout))
+                channel.healthy = device.healthy
+                self._channels[device.id] = channel
+            return channel
+
+    def submit(self, email, pin, device, key=None, on_done=None):
+        # Returns a future resolving to DELIVERED or FAILED. The device uses key to drop
+        # duplicates; on_done(device_id, result, error) runs on the delivery thread.
+        self._ensure_started()
+        channel = self._channel(device)
+        ticket = next(self._tickets)
+        with self._lock:
+            channel.submitted += 1
+            self._queued[ticket] = time.perf_counter()
+        return self._executor.submit(self._deliver, email, pin, device, channel, key, on_done, ticket)
+
+    def dispatch(self, email, pin, devices, wait=0.0, keys=None, on_done=None):
+        # Sends the PIN to every device at once and waits up to `wait` seconds for them.
+        # Returns the overall result and the result per device id: FAILED when no device
+        # can get it, DELIVERED once at least one has it and none is still pending,
+        # otherwise ACCEPTED.
+        self._ensure_started()
+        keys = keys or {}
+        results = {}
+        futures = {}
+        for device in devices:
+            channel = self._channel(device)
+            if not channel.breaker.allow():
+                with self._lock:
+                    channel.short_circuited += 1
+                logger.error("Circuit open for device %s, not sending PIN for %s", device.id, email)
+                results[device.id] = FAILED
+                if on_done is not None:
+                    on_done(device.id, FAILED, 'circuit open')
+                continue
+            futures[self.submit(email, pin, device, keys.get(device.id), on_done)] = device.id
+        if futures and wait > 0:
+            futures_wait(futures, timeout=wait)
+        for future, device_id in futures.items():
+            if not future.done():
+                results[device_id] = ACCEPTED
+            else:
+                results[device_id] = FAILED if future.exception() else future.result()
+
+        statuses = set(results.values())
+        if not statuses or statuses == {FAILED}:
+            return FAILED, results
+        if ACCEPTED in statuses:
+            return ACCEPTED, results
+        return DELIVERED, results
+
+    def _set_health(self, device, channel, healthy, error=None):
+        with self._lock:
+            changed = channel.healthy != healthy
+            channel.healthy = healthy
+        if changed:
+            logger.log(logging.INFO if healthy else logging.WARNING,
+                       "Device %s is %s", device.id, 'back up' if healthy else f'down: {error}')
+            if self.registry is not None:
+                try:
+                    self.registry.record_health(device.id, healthy, error)
+                except Exception:
+                    logger.exception("Could not record health of device %s", device.id)
+
+    def queue_delay(self):
+        # Seconds the oldest delivery has waited for a thread, 0 when none is waiting
+        with self._lock:
+            oldest = next(iter(self._queued.values()), None)
+        return time.perf_counter() - oldest if oldest is not None else 0.0
+
+    def _deliver(self, email, pin, device, channel, key=None, on_done=None, ticket=None):
+        with self._lock:
+            self._queued.pop(ticket, None)
+        result, error = self._attempt(email, pin, device, channel, key)
+        if on_done is not None:
+            try:
+                on_done(device.id, result, error)
+            except Exception:
+                logger.exception("PIN delivery callback failed for device %s", device.id)
+        return result
+
+    def _attempt(self, email, pin, device, channel, key):
+        payload = {'email': email, 'pin': pin}
+        headers = {}
+        if key:
+            payload['idempotencyKey'] = key
+            headers['Idempotency-Key'] = key
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt > 1 and not channel.breaker.allow():
+                with self._lock:
+                    channel.short_circuited += 1
+                    channel.failed += 1
+                metrics.inc('errors_total', stage='esp32')
+                logger.error("Circuit open for device %s, giving up on PIN for %s", device.id, email)
+                return FAILED, 'circuit open'
+            try:
+                with metrics.timer('esp32_request_duration_seconds', device=device.id):
+                    response = channel.session.post(device.address, json=payload, headers=headers, timeout=self.timeout)
+                if response.status_code == 200:
+                    channel.breaker.record_success()
+                    self._set_health(device, channel, True)
+                    elapsed = time.perf_counter() - start
+                    with self._lock:
+                        channel.delivered += 1
+                        channel.delivery_time += elapsed
+                    metrics.observe('esp32_delivery_duration_seconds', elapsed, device=device.id)
+                    logger.info("PIN for %s sent to device %s successfully.", email, device.id)
+                    return DELIVERED, None
+                retryable = response.status_code >= 500
+                error = f"HTTP {response.status_code}: {response.text}"
+                if retryable:
+                    channel.breaker.record_failure()
+                else:
+                    channel.breaker.record_success()  # The device answered, it only rejected this PIN
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retryable = True
+                error = str(e)
+                channel.breaker.record_failure()
+            except Exception as e:
+                retryable = False
+                error = str(e)
+                channel.breaker.record_failure()
+
+            if not retryable or attempt > self.max_retries:
+                if retryable:
+                    self._set_health(device, channel, False, error)
+                with self._lock:
+                    channel.failed += 1
+                metrics.inc('errors_total', stage='esp32')
+                logger.error("Failed to send PIN to device %s after %d attempt(s): %s", device.id, attempt, error)
+                return FAILED, error
+
+            # Full jitter keeps retries from several workers from lining up
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+            with self._lock:
+                channel.retries += 1
+            logger.warning("Delivery attempt %d to device %s failed (%s), retrying in %.2fs",
+                           attempt, device.id, error, delay)
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            devices = {}
+            for device_id, channel in self._channels.items():
+                delivered = channel.delivered
+                devices[device_id] = {
+                    'address': channel.address,
+                    'healthy': channel.healthy,
+                    'breaker': channel.breaker.state,
+                    'submitted': channel.submitted,
+                    'delivered': delivered,
+                    'failed': channel.failed,
+                    'retries': channel.retries,
+                    'short_circuited': channel.short_circuited,
+                    'avg_delivery_ms': channel.delivery_time / delivered * 1000 if delivered else 0.0,
+                }
+        totals = {key: sum(d[key] for d in devices.values())
+                  for key in ('submitted', 'delivered', 'failed', 'retries', 'short_circuited')}
+        return dict(totals, devices=devices)
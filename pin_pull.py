@@ -0,0 +1,93 @@
+# Wake-ups for ESP32 devices that pull their PINs (long-poll or Server-Sent Events)
+# because the server cannot reach them, e.g. behind NAT.
+#
+# A waiting request blocks on its device's condition variable; /api/sendPin notifies
+# exactly that device. The PINs themselves stay in the outbox table, so a device served
+# by another worker process still finds them on its next recheck.
+import threading
+import time
+
+import metrics
+
+
+class TooManyWaiters(Exception):
+    pass
+
+
+class _Slot:
+    __slots__ = ('cond', 'waiters')
+
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.waiters = 0
+
+
+class PinMailbox:
+    def __init__(self, max_waiters=1000, max_waiters_per_device=2):
+        self.max_waiters = max_waiters
+        self.max_waiters_per_device = max_waiters_per_device
+        self._lock = threading.Lock()
+        self._slots = {}  # device id -> _Slot, only while a request waits for it
+        self._versions = {}  # device id -> notify count, one entry per device ever notified
+        self._notified_at = {}
+        self._waiters = 0
+        self._notifies = 0
+        self._wakeups = 0
+        self._rejected = 0
+
+    def version(self, device_id):
+        # Read before checking for PINs and pass to wait(), so a notify in between is not lost
+        with self._lock:
+            return self._versions.get(device_id, 0)
+
+    def notify(self, device_id):
+        # Returns whether a request of this process was waiting for the device
+        with self._lock:
+            self._notifies += 1
+            self._versions[device_id] = self._versions.get(device_id, 0) + 1
+            self._notified_at[device_id] = time.perf_counter()
+            slot = self._slots.get(device_id)
+            if slot is None:
+                return False
+            slot.cond.notify_all()
+            return True
+
+    def wait(self, device_id, since, timeout):
+        # Blocks until notify(device_id) or timeout. Returns True when woken.
+        with self._lock:
+            if self._versions.get(device_id, 0) != since:
+                return True
+            slot = self._slots.get(device_id)
+            if self._waiters >= self.max_waiters or (slot and slot.waiters >= self.max_waiters_per_device):
+                self._rejected += 1
+                raise TooManyWaiters(device_id)
+            if slot is None:
+                slot = self._slots[device_id] = _Slot(self._lock)
+            slot.waiters += 1
+            self._waiters += 1
+            try:
+                woken = slot.cond.wait_for(lambda: self._versions.get(device_id, 0) != since, timeout)
+                if woken:
+                    self._wakeups += 1
+                    metrics.observe('pin_pull_wake_seconds', time.perf_counter() - self._notified_at[device_id])
+                return woken
+            finally:
+                slot.waiters -= 1
+                self._waiters -= 1
+                if not slot.waiters:
+                    del self._slots[device_id]
+
+    def waiting(self):
+        with self._lock:
+            return self._waiters
+
+    def stats(self):
+        with self._lock:
+            return {
+                'waiters': self._waiters,
+                'devices_waiting': len(self._slots),
+                'max_waiters': self.max_waiters,
+                'notifies': self._notifies,
+                'wakeups': self._wakeups,
+                'rejected': self._rejected,
+            }
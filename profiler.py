@@ -0,0 +1,180 @@
+# Opt-in sampling profiler for requests, written as collapsed stacks for flamegraph tools
+# (flamegraph.pl, speedscope, inferno):
+#
+#   route;module.function;module.function... samples
+#
+# Profiled requests are picked at random (sample_rate) or by an X-Profile header from a
+# trusted IP. While at least one profiled request is running, a background thread looks
+# at its stack every `interval` seconds and counts it under the request's route. Nothing
+# runs when no request is being profiled, and app.py does not install the hooks at all
+# when profiling is off.
+#
+# With threads the samples are taken from sys._current_frames(), so they show where the
+# request spends wall time, running or blocked. Under gevent the sampler is a greenlet
+# too and only sees requests while they are suspended, so the profile shows where they
+# wait on I/O rather than CPU time.
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Profile'
+MAX_DEPTH = 128
+
+
+def _gevent_patched():
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('threading')
+
+
+def _label(code):
+    # Stable per function, so samples from different lines of it merge into one frame
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f'{module}.{code.co_name}'.replace(';', ':').replace(' ', '_')
+
+
+def collapse(frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class RequestProfiler:
+    def __init__(self, sample_rate=0.0, trusted_ips=(), interval=0.005, output_dir=None, flush_interval=10.0):
+        self.sample_rate = sample_rate
+        self.trusted_ips = frozenset(trusted_ips)
+        self.interval = interval
+        self.output_dir = output_dir
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._busy = threading.Event()  # Set while any profiled request is running
+        self._active = {}  # task -> route
+        self._stacks = {}  # route -> Counter of collapsed stacks
+        self._dirty = False
+        self._pid = None
+        self._profiled = 0
+        self._samples = 0
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or bool(self.trusted_ips)
+
+    def wanted(self, remote_addr, headers):
+        if headers.get(HEADER) and remote_addr in self.trusted_ips:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _ensure_started(self):
+        # The sampler thread does not survive a fork, every worker runs its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._active = {}
+            self._stacks = {}
+            threading.Thread(target=self._run, name='request-profiler', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _task(self):
+        if _gevent_patched():
+            import greenlet
+            return greenlet.getcurrent()
+        return threading.get_ident()
+
+    def start(self, route):
+        # Returns a token for stop()
+        self._ensure_started()
+        task = self._task()
+        with self._lock:
+            self._active[task] = route
+            self._profiled += 1
+            self._busy.set()
+        return task
+
+    def stop(self, task):
+        with self._lock:
+            self._active.pop(task, None)
+            if not self._active:
+                self._busy.clear()
+
+    def _frames(self, tasks):
+        if tasks and not isinstance(tasks[0], int):
+            return {task: task.gr_frame for task in tasks}
+        frames = sys._current_frames()
+        return {task: frames.get(task) for task in tasks}
+
+    def _run(self):
+        flushed_at = time.monotonic()
+        while True:
+            if self._busy.wait(self.flush_interval):
+                time.sleep(self.interval)
+                self._sample()
+            if self.output_dir and time.monotonic() - flushed_at >= self.flush_interval:
+                flushed_at = time.monotonic()
+                try:
+                    self.write(self.output_dir)
+                except OSError:
+                    logger.exception("Could not write profiles to %s", self.output_dir)
+
+    def _sample(self):
+        with self._lock:
+            active = dict(self._active)
+        if not active:
+            return
+        frames = self._frames(list(active))
+        stacks = [(route, collapse(frames[task])) for task, route in active.items() if frames.get(task) is not None]
+        with self._lock:
+            for route, stack in stacks:
+                self._stacks.setdefault(route, Counter())[f'{route};{stack}'] += 1
+            self._samples += len(stacks)
+            self._dirty = self._dirty or bool(stacks)
+
+    def collapsed(self, route=None):
+        # Collapsed-stack text for one route or all of them, heaviest stacks first
+        with self._lock:
+            counters = [self._stacks[route]] if route in self._stacks else [] if route else list(self._stacks.values())
+            lines = [f'{stack} {count}' for counter in counters for stack, count in counter.most_common()]
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write(self, directory):
+        # One file per route and worker: <route>.<pid>.folded, rewritten with the totals so far
+        with self._lock:
+            if not self._dirty:
+                return 0
+            self._dirty = False
+            routes = list(self._stacks)
+        os.makedirs(directory, exist_ok=True)
+        for route in routes:
+            name = re.sub(r'[^A-Za-z0-9_.-]+', '_', route).strip('_') or 'root'
+            path = os.path.join(directory, f'{name}.{os.getpid()}.folded')
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.collapsed(route))
+            os.replace(path + '.tmp', path)
+        return len(routes)
+
+    def reset(self):
+        with self._lock:
+            self._stacks = {}
+            self._dirty = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'interval_ms': self.interval * 1000,
+                'profiled_requests': self._profiled,
+                'active': len(self._active),
+                'samples': self._samples,
+                'routes': {route: sum(counter.values()) for route, counter in self._stacks.items()},
+            }
@@ -0,0 +1,51 @@
+import math
+from functools import wraps
+
+from flask import request, jsonify, g
+
+import metrics
+
+
+def parse_rule(spec):
+    # '5/300' -> 5 requests per 300 seconds, allowing a burst of 5
+    count, _, seconds = spec.partition('/')
+    capacity = float(count)
+    return capacity, capacity / float(seconds)
+
+
+class RateLimiter:
+    # Token buckets keyed by email and client IP, kept in the state backend so the
+    # limits hold across workers when the backend is shared
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def check(self, route, limits):
+        # limits: iterable of (scope, key, spec). Returns seconds to wait, 0 when allowed.
+        wait = 0.0
+        for scope, key, spec in limits:
+            if not key or not spec:
+                continue
+            capacity, rate = parse_rule(spec)
+            scope_wait = self.backend.consume(f'rate:{route}:{scope}', str(key), capacity, rate)
+            if scope_wait:
+                metrics.inc('rate_limited_total', route=route, scope=scope)
+                wait = max(wait, scope_wait)
+        return wait
+
+    def limit(self, route, email_spec=None, ip_spec=None):
+        # Decorator answering 429 with Retry-After before the view does any work
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                data = g.get('body') or request.get_json(silent=True)  # Parsed already by schemas.body
+                email = data.get('email') if isinstance(data, dict) else None
+                wait = self.check(route, (('email', email, email_spec), ('ip', request.remote_addr, ip_spec)))
+                if wait:
+                    response = jsonify(success=False, message='Too many requests, try again later')
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(math.ceil(wait))
+                    return response
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
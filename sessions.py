@@ -0,0 +1,94 @@
+# Signed, stateless session tokens handed out once an OTP is verified.
+#
+# A token carries the email and a random id, signed with itsdangerous and timestamped,
+# so checking one is a signature and expiry check with no database or store lookup.
+# Logged-out token ids go into a small revocation set in the state backend that each
+# process re-reads at most every refresh_interval seconds.
+import logging
+import secrets
+import threading
+import time
+from functools import wraps
+
+from flask import request, jsonify, g
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+import metrics
+import state
+
+logger = logging.getLogger(__name__)
+
+
+def bearer_token():
+    auth = request.headers.get('Authorization', '')
+    return auth[7:] if auth.startswith('Bearer ') else None
+
+
+class SessionTokens:
+    SALT = 'esss-session'
+
+    def __init__(self, secret_keys, ttl=600, backend=None, refresh_interval=5.0):
+        # secret_keys: oldest first. The last one signs, all of them verify, so a new key
+        # can be appended and the oldest dropped once its tokens have expired.
+        if not secret_keys:
+            raise ValueError("At least one secret key is required, shared by every worker")
+        self.serializer = URLSafeTimedSerializer(list(secret_keys), salt=self.SALT)
+        self.ttl = ttl
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._revoked = frozenset()
+        self._refreshed_at = None
+
+    def issue(self, email):
+        metrics.inc('session_tokens_total', result='issued')
+        return self.serializer.dumps({'sub': email, 'jti': secrets.token_urlsafe(9)})
+
+    def _load(self, token):
+        try:
+            return self.serializer.loads(token, max_age=self.ttl), None
+        except SignatureExpired:
+            return None, 'expired'
+        except BadSignature:
+            return None, 'invalid'
+
+    def _revoked_ids(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.backend is None or (self._refreshed_at is not None
+                                        and now - self._refreshed_at < self.refresh_interval):
+                return self._revoked
+        revoked = frozenset(self.backend.keys(state.SESSION_REVOKED))
+        with self._lock:
+            self._revoked = revoked
+            self._refreshed_at = now
+            return revoked
+
+    def validate(self, token):
+        # Returns the email the token was issued to, or None
+        data, error = self._load(token) if token else (None, 'missing')
+        if data is not None and data.get('jti') in self._revoked_ids():
+            data, error = None, 'revoked'
+        metrics.inc('session_tokens_total', result=error or 'accepted')
+        return data['sub'] if data else None
+
+    def revoke(self, token):
+        data, _ = self._load(token)
+        if data is None:
+            return False  # Already unusable
+        if self.backend is not None:
+            self.backend.set(state.SESSION_REVOKED, data['jti'], 1)
+        with self._lock:
+            self._revoked = self._revoked | {data['jti']}
+        return True
+
+    def required(self, view):
+        # Decorator: 401 unless the request carries a valid token; the email is in g.session_email
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            email = self.validate(bearer_token())
+            if email is None:
+                return jsonify(success=False, message='Verify your OTP first'), 401
+            g.session_email = email
+            return view(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,223 @@
+import json
+import threading
+import time
+
+import db
+from expiring import ExpiringStore
+
+# Namespaces used by the app
+OTP = 'otp'
+OTP_USED = 'otp_used'  # Replay protection for stateless OTPs
+OTP_ISSUED = 'otp_issued'  # Marks an OTP that may still be reused for a repeated request
+OTP_COOLDOWN = 'otp_cooldown'  # Held while an OTP mail was just sent, deduplicates sends
+PIN = 'pin'
+SESSION_REVOKED = 'session_revoked'  # Ids of session tokens logged out before they expire
+
+
+class StateBackend:
+    # Short-lived per-email state (OTPs, PINs) with a TTL per namespace.
+    # Implementations must make pop_if_equal atomic so an OTP verifies at most once.
+
+    def set(self, namespace, key, value, conn=None):
+        # conn: an open db connection whose transaction the write should join;
+        # backends that don't live in the database ignore it
+        raise NotImplementedError
+
+    def add(self, namespace, key, value):
+        # Set only if absent, atomically; returns whether the key was set
+        raise NotImplementedError
+
+    def get(self, namespace, key):
+        raise NotImplementedError
+
+    def pop_if_equal(self, namespace, key, expected):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def keys(self, namespace):
+        # Live keys of a namespace; meant for small namespaces only
+        raise NotImplementedError
+
+    def consume(self, namespace, key, capacity, rate):
+        # Token bucket: take one token from the bucket for key. Returns 0 when allowed,
+        # otherwise the seconds until a token is available.
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+def _take_token(tokens, updated, now, capacity, rate):
+    # Returns (tokens left, seconds to wait); waiting means nothing was taken
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend(StateBackend):
+    # Per-process state, only correct with a single worker process
+    def __init__(self, ttls, max_size=100000):
+        self.max_size = max_size
+        self._stores = {name: ExpiringStore(ttl, max_size=max_size) for name, ttl in ttls.items()}
+        self._buckets = {}
+        self._bucket_lock = threading.Lock()
+
+    def set(self, namespace, key, value, conn=None):
+        self._stores[namespace][key] = value
+
+    def add(self, namespace, key, value):
+        return self._stores[namespace].add(key, value)
+
+    def get(self, namespace, key):
+        return self._stores[namespace].get(key)
+
+    def pop_if_equal(self, namespace, key, expected):
+        return self._stores[namespace].pop_if_equal(key, expected)
+
+    def delete(self, namespace, key):
+        self._stores[namespace].pop(key)
+
+    def keys(self, namespace):
+        return self._stores[namespace].keys()
+
+    def consume(self, namespace, key, capacity, rate):
+        with self._bucket_lock:
+            store = self._buckets.get(namespace)
+            if store is None:
+                # An untouched bucket is full again after capacity / rate seconds, so it can expire then
+                store = self._buckets[namespace] = ExpiringStore(capacity / rate, max_size=self.max_size)
+            now = time.monotonic()
+            tokens, updated = store.get(key) or (capacity, now)
+            tokens, wait = _take_token(tokens, updated, now, capacity, rate)
+            store[key] = (tokens, now)
+        return wait
+
+    def stats(self):
+        stats = {name: store.stats() for name, store in self._stores.items()}
+        with self._bucket_lock:
+            stats.update({name: store.stats() for name, store in self._buckets.items()})
+        return {'backend': 'memory', **stats}
+
+
+class SQLiteBackend(StateBackend):
+    # State kept in a table of the shared database, so every gunicorn worker
+    # (and every host mounting the same file) sees the same OTPs and PINs
+    SWEEP_INTERVAL = 30.0  # Seconds between deletes of expired rows
+
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._expirations = 0
+
+    def _maybe_sweep(self, conn, now):
+        with self._lock:
+            if now - self._last_sweep < self.SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+        deleted = conn.execute('DELETE FROM auth_state WHERE expires_at <= ?', (now,)).rowcount
+        conn.execute('DELETE FROM rate_buckets WHERE expires_at <= ?', (now,))
+        with self._lock:
+            self._expirations += deleted
+
+    def set(self, namespace, key, value, conn=None):
+        if conn is not None:
+            self._set(conn, namespace, key, value)
+            return
+        with db.connection() as conn:
+            self._set(conn, namespace, key, value)
+
+    def _set(self, conn, namespace, key, value):
+        now = time.time()
+        conn.execute(
+            'INSERT INTO auth_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at',
+            (namespace, key, json.dumps(value), now + self.ttls[namespace]),
+        )
+        self._maybe_sweep(conn, now)
+
+    def add(self, namespace, key, value):
+        # An expired row counts as absent, so it may be overwritten
+        now = time.time()
+        with db.connection() as conn:
+            changed = conn.execute(
+                'INSERT INTO auth_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at '
+                'WHERE auth_state.expires_at <= ?',
+                (namespace, key, json.dumps(value), now + self.ttls[namespace], now),
+            ).rowcount
+            self._maybe_sweep(conn, now)
+        return changed == 1
+
+    def get(self, namespace, key):
+        with db.connection() as conn:
+            row = conn.execute(
+                'SELECT value FROM auth_state WHERE namespace = ? AND key = ? AND expires_at > ?',
+                (namespace, key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pop_if_equal(self, namespace, key, expected):
+        # A single DELETE is atomic across processes, so only one worker can win
+        with db.connection() as conn:
+            deleted = conn.execute(
+                'DELETE FROM auth_state WHERE namespace = ? AND key = ? AND value = ? AND expires_at > ?',
+                (namespace, key, json.dumps(expected), time.time()),
+            ).rowcount
+        return deleted == 1
+
+    def delete(self, namespace, key):
+        with db.connection() as conn:
+            conn.execute('DELETE FROM auth_state WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def keys(self, namespace):
+        with db.connection() as conn:
+            rows = conn.execute(
+                'SELECT key FROM auth_state WHERE namespace = ? AND expires_at > ?', (namespace, time.time())
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def consume(self, namespace, key, capacity, rate):
+        now = time.time()
+        with db.connection() as conn:
+            # Take the write lock up front so read-modify-write is atomic across workers
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT tokens, updated FROM rate_buckets WHERE namespace = ? AND key = ?', (namespace, key)
+            ).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, wait = _take_token(tokens, updated, now, capacity, rate)
+            conn.execute(
+                'INSERT INTO rate_buckets (namespace, key, tokens, updated, expires_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (namespace, key) DO UPDATE SET tokens = excluded.tokens, '
+                'updated = excluded.updated, expires_at = excluded.expires_at',
+                (namespace, key, tokens, now, now + capacity / rate),
+            )
+            self._maybe_sweep(conn, now)
+        return wait
+
+    def stats(self):
+        with db.connection() as conn:
+            rows = conn.execute(
+                'SELECT namespace, COUNT(*) FROM auth_state WHERE expires_at > ? GROUP BY namespace',
+                (time.time(),),
+            ).fetchall()
+        sizes = dict(rows)
+        with self._lock:
+            expirations = self._expirations
+        return {
+            'backend': 'sqlite',
+            'expirations': expirations,
+            **{name: {'size': sizes.get(name, 0), 'ttl': ttl} for name, ttl in self.ttls.items()},
+        }
+
+
+def create_backend(name, ttls, max_size=100000):
+    if name == 'memory':
+        return MemoryBackend(ttls, max_size=max_size)
+    if name == 'sqlite':
+        return SQLiteBackend(ttls)
+    raise ValueError(f"Unknown state backend: {name}")
@@ -0,0 +1,89 @@
+# Bounded LRU cache of user ids by email, so repeated lookups skip the users table.
+#
+# Only the id is kept, never the password hash: a password changed through one worker
+# must stop working in every worker at once, and ids never change. Unknown emails are
+# cached too, for a shorter time, so a burst of attempts against a nonexistent account
+# costs one query; an insert in this process invalidates the entry, one made by another
+# process shows up once the negative TTL runs out.
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class UserCache:
+    def __init__(self, max_size=10000, ttl=300.0, negative_ttl=30.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._data = OrderedDict()  # email -> (expires_at, id or None), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, email, unknown_only=False):
+        # Returns the user id, or None for an email known not to exist. KeyError when not cached.
+        # unknown_only: for callers that read the row anyway, a cached id is a miss too.
+        with self._lock:
+            entry = self._data.get(email)
+            if entry is not None and entry[0] > self._clock():
+                self._data.move_to_end(email)
+                if entry[1] is None:
+                    self.negative_hits += 1
+                    result = 'negative_hit'
+                elif unknown_only:
+                    self.misses += 1
+                    result = 'miss'
+                else:
+                    self.hits += 1
+                    result = 'hit'
+                value = entry[1]
+            else:
+                if entry is not None:
+                    del self._data[email]
+                self.misses += 1
+                result = 'miss'
+        metrics.inc('user_cache_requests_total', result=result)
+        if result == 'miss':
+            raise KeyError(email)
+        return value
+
+    def set(self, email, user_id):
+        # user_id: None when there is no such email
+        ttl = self.ttl if user_id is not None else self.negative_ttl
+        with self._lock:
+            if email in self._data:
+                del self._data[email]
+            elif len(self._data) >= self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[email] = (self._clock() + ttl, user_id)
+
+    def invalidate(self, email):
+        with self._lock:
+            self._data.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }